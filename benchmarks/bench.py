@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the stampede worker. Runs a fresh worker and prints the results as JSON::
+
+    python benchmarks/bench.py run --output before.json
+    python benchmarks/bench.py run --output after.json
+    python benchmarks/bench.py compare before.json after.json
+
+Scenarios:
+
+* ``latency``: sequential ``stampede.request()`` roundtrips (connect included) with distinct keys.
+* ``same_key_N``: N concurrent clients requesting the same key (how well requests collapse).
+* ``distinct_keys_N``: N concurrent clients requesting distinct keys (accept + fork throughput).
+* ``accept_N``: N clients connecting at once (non-blocking connects so a full backlog shows up as ``refused``) until
+  they all got the protocol greeting (accept throughput).
+* ``startup``: time from fork until a task has imported its (non-trivial) dependencies. Compare a run with
+  ``--preload`` (the dependencies are imported in ``StampedeWorker.preload``) to one without.
+* ``fork`` and ``fanout``: the worker's own submit/task/fan-out timings (from its stats) over all the scenarios. With
+  ``--shards`` these only cover the shard that answered the stats request.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import errno
+import json
+import os
+import platform
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import count
+
+from stampede import client
+from stampede.poller import READ
+from stampede.poller import DefaultPoller
+from stampede.protocol import HANDSHAKE
+from stampede.protocol import encode_request
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+FD_LIMIT = 65536
+unique = count()
+
+
+def make_key(task_time):
+    return ("sleep:%s:%s" % (task_time, next(unique))).encode("ascii")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": max(values),
+    }
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # the soft limit can't be infinite (nor above fs.nr_open)
+    wanted = FD_LIMIT if hard == resource.RLIM_INFINITY else min(hard, FD_LIMIT)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+class Worker(object):
+    def __init__(self, executor, max_tasks, shards, preload):
+        self.tmp = tempfile.mkdtemp(prefix="stampede-bench-")
+        self.path = os.path.join(self.tmp, "bench")
+        argv = [sys.executable, WORKER, self.path, executor, str(max_tasks), str(shards)]
+        if preload:
+            argv.append("preload")
+        self.proc = subprocess.Popen(argv, preexec_fn=raise_fd_limit)
+        t = time.time()
+        while not os.path.exists("%s.sock" % self.path):
+            if self.proc.poll() is not None or time.time() - t > 10:
+                raise RuntimeError("Worker failed to start.")
+            time.sleep(0.01)
+
+    def stats(self):
+        return client.stats(self.path)
+
+    def close(self):
+        # SIGINT so the worker gets to shut down its executor (pool processes included)
+        self.proc.send_signal(signal.SIGINT)
+        self.proc.wait()
+        shutil.rmtree(self.tmp)
+
+
+def bench_latency(worker, iterations):
+    timings = []
+    for _ in range(iterations):
+        key = make_key(0)
+        t = time.time()
+        client.request(worker.path, key)
+        timings.append(time.time() - t)
+    return summarize(timings)
+
+
+def bench_startup(worker, iterations):
+    timings = []
+    for _ in range(iterations):
+        result = client.request(worker.path, b"startup:%d" % next(unique)).result
+        if result is None:  # not a forking executor
+            return None
+        timings.append(float(result))
+    return summarize(timings)
+
+
+def bench_concurrent(worker, keys):
+    """
+    Connects and sends a request for every key as fast as possible then waits for all the responses (on a single
+    thread, so it can drive thousands of connections).
+    """
+    before = worker.stats()
+    poller = DefaultPoller()
+    pending = {}
+    started = time.time()
+    for key in keys:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect("%s.sock" % worker.path)
+        sock.sendall(HANDSHAKE + b"\n" + encode_request(1, key))
+        sock.setblocking(False)
+        poller.register(sock, READ)
+        pending[sock] = [time.time(), b""]
+    timings = []
+    while pending:
+        for sock, _ in poller.poll(10):
+            state = pending[sock]
+            state[1] += sock.recv(65536)
+            if state[1].count(b"\n") >= 2:  # hello + response
+                timings.append(time.time() - state[0])
+                poller.unregister(sock)
+                sock.close()
+                del pending[sock]
+    elapsed = time.time() - started
+    poller.close()
+    after = worker.stats()
+    result = summarize(timings)
+    result.update(
+        clients=len(keys),
+        elapsed=elapsed,
+        requests_per_second=len(keys) / elapsed,
+        tasks_started=after["counters"]["tasks_started"] - before["counters"]["tasks_started"],
+    )
+    return result
+
+
+def bench_accept(worker, clients):
+    poller = DefaultPoller()
+    pending = set()
+    refused = 0
+    started = time.time()
+    for _ in range(clients):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            sock.connect("%s.sock" % worker.path)
+        except socket.error as exc:
+            if exc.errno not in (errno.EAGAIN, errno.ECONNREFUSED):
+                raise
+            refused += 1
+            sock.close()
+            continue
+        sock.send(HANDSHAKE + b"\n")
+        poller.register(sock, READ)
+        pending.add(sock)
+    while pending:
+        for sock, _ in poller.poll(10):
+            if sock.recv(100):
+                poller.unregister(sock)
+                sock.close()
+                pending.discard(sock)
+    elapsed = time.time() - started
+    poller.close()
+    return {
+        "clients": clients,
+        "refused": refused,
+        "elapsed": elapsed,
+        "accepts_per_second": (clients - refused) / elapsed,
+    }
+
+
+def histogram_mean(stats, name):
+    histogram = stats["histograms"][name]
+    return histogram["sum"] / histogram["count"] if histogram["count"] else None
+
+
+def run(args):
+    raise_fd_limit()
+    worker = Worker(args.executor, args.max_tasks, args.shards, args.preload)
+    try:
+        results = {"latency": bench_latency(worker, args.iterations)}
+        startup = bench_startup(worker, args.iterations)
+        if startup:
+            results["startup"] = startup
+        for clients in args.clients:
+            results["same_key_%s" % clients] = bench_concurrent(worker, [make_key(args.task_time)] * clients)
+            results["distinct_keys_%s" % clients] = bench_concurrent(worker, [
+                make_key(args.task_time) for _ in range(clients)
+            ])
+            results["accept_%s" % clients] = bench_accept(worker, clients)
+        stats = worker.stats()
+        results["fork"] = {
+            "submit_mean": histogram_mean(stats, "submit_seconds"),
+            "task_mean": histogram_mean(stats, "task_seconds"),
+        }
+        results["fanout"] = {
+            "mean": histogram_mean(stats, "fanout_seconds"),
+            "clients_mean": histogram_mean(stats, "task_clients"),
+        }
+    finally:
+        worker.close()
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "executor": args.executor,
+            "max_tasks": args.max_tasks,
+            "shards": args.shards,
+            "task_time": args.task_time,
+            "preload": args.preload,
+            "time": time.time(),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output)
+    print(output)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(WORKER), stderr=subprocess.STDOUT
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results):
+    for scenario, values in sorted(results.items()):
+        for name, value in sorted(values.items()):
+            if name not in ("clients", "count") and isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield "%s.%s" % (scenario, name), value
+
+
+def compare(args):
+    with open(args.before) as fh:
+        before = json.load(fh)
+    with open(args.after) as fh:
+        after = json.load(fh)
+    print("%-40s %14s %14s %8s" % ("metric", before["meta"]["commit"], after["meta"]["commit"], "ratio"))
+    after_results = dict(flatten(after["results"]))
+    for name, old in flatten(before["results"]):
+        new = after_results.get(name)
+        if new is None:
+            continue
+        print("%-40s %14.6g %14.6g %8s" % (name, old, new, "%.2f" % (new / old) if old else "-"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument("--executor", default="ForkExecutor",
+                            help="Executor class from stampede.executors (default: %(default)s).")
+    run_parser.add_argument("--max-tasks", type=int, default=64,
+                            help="Worker's max_tasks, 0 means unlimited (default: %(default)s).")
+    run_parser.add_argument("--shards", type=int, default=0,
+                            help="Worker's shards (event loop processes), 0 means a single loop (default: %(default)s).")
+    run_parser.add_argument("--iterations", type=int, default=200,
+                            help="Roundtrips for the latency benchmark (default: %(default)s).")
+    run_parser.add_argument("--clients", type=lambda value: [int(item) for item in value.split(",")],
+                            default=[1, 100, 10000],
+                            help="Comma separated concurrent client counts (default: 1,100,10000).")
+    run_parser.add_argument("--task-time", type=float, default=0,
+                            help="How long every task sleeps (default: %(default)s).")
+    run_parser.add_argument("--preload", action="store_true",
+                            help="Import the task dependencies in the worker's preload() hook.")
+    run_parser.add_argument("--output", help="Also write the results to this file.")
+    compare_parser = commands.add_parser("compare", help="Compare two result files.")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    args = parser.parse_args()
+    if args.command == "compare":
+        compare(args)
+    elif args.command == "run":
+        run(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Worker used by ``bench.py``. Usage: ``worker.py PATH EXECUTOR MAX_TASKS SHARDS [preload]``.
+
+Keys like ``b"sleep:0.1:whatever"`` sleep for the given time. Keys like ``b"startup:whatever"`` import a bunch of
+modules (like a real task would) and return how long after the fork that finished. Anything else is a no-op task.
+"""
+import importlib
+import sys
+import time
+
+from stampede import StampedeWorker
+from stampede import executors
+
+TASK_MODULES = (
+    "asyncio",
+    "decimal",
+    "email.mime.multipart",
+    "http.client",
+    "unittest",
+    "xml.dom.minidom",
+)
+
+
+def import_task_modules():
+    for name in TASK_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+class BenchmarkWorker(StampedeWorker):
+    request_timeout = 60
+
+    def handle_task(self, key, payload=None):
+        if key.startswith(b"sleep:"):
+            time.sleep(float(key.split(b":")[1]))
+        elif key.startswith(b"startup:"):
+            import_task_modules()
+            forked_at = getattr(self.executor, "forked_at", None)
+            if forked_at is not None:
+                return ("%.9f" % (time.time() - forked_at)).encode("ascii")
+
+
+class PreloadingBenchmarkWorker(BenchmarkWorker):
+    def preload(self):
+        import_task_modules()
+
+
+if __name__ == "__main__":
+    path, executor, max_tasks, shards = sys.argv[1:5]
+    worker_class = PreloadingBenchmarkWorker if sys.argv[5:] == ["preload"] else BenchmarkWorker
+    worker_class.executor_class = getattr(executors, executor)
+    worker_class.max_tasks = int(max_tasks) or None
+    worker_class.shards = int(shards) or None
+    try:
+        worker_class(path).run()
+    except KeyboardInterrupt:
+        pass
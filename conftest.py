@@ -0,0 +1,10 @@
+import sys
+
+collect_ignore = []
+if sys.version_info[0] == 2:
+    # these have async/await syntax that Python 2 can't even compile (--doctest-modules imports all the modules)
+    collect_ignore += [
+        "src/stampede/aio.py",
+        "tests/helper_aio.py",
+        "tests/test_aio.py",
+    ]
@@ -1,6 +1,8 @@
+from .client import Client
 from .client import request
 from .client import request_and_spawn
+from .client import request_many
 from .worker import StampedeWorker
 
 __version__ = '2.0.0'
-__all__ = 'request', 'request_and_spawn', 'StampedeWorker'
+__all__ = 'Client', 'request', 'request_and_spawn', 'request_many', 'StampedeWorker'
@@ -0,0 +1,247 @@
+import asyncio
+import itertools
+import os
+from contextlib import closing
+from logging import getLogger
+
+from .client import LegacyWorker
+from .client import TaskFailed
+from .client import check_key
+from .client import make_result
+from .client import spawn
+from .poller import READ
+from .poller import WRITE
+from .protocol import HANDSHAKE
+from .protocol import TIMEOUT_EXIT_CODE
+from .protocol import VERSION
+from .protocol import ProtocolError
+from .protocol import decode_line
+from .protocol import encode_request
+from .utils import get_exit_code
+from .utils import monotonic
+from .worker import StampedeWorker
+
+logger = getLogger(__name__)
+
+
+async def request(path, key, wait=True, timeout=None, payload=None, stale=False):
+    """
+    Asyncio variant of :func:`stampede.request`. A ``timeout`` (or cancellation) closes the connection and raises.
+    """
+    logger.info("request %r wait=%s", key, wait)
+    check_key(key)
+    try:
+        try:
+            return await asyncio.wait_for(communicate(path, key, wait, payload, stale), timeout)
+        except LegacyWorker:
+            if payload is not None or stale:
+                raise
+            logger.info("request key=%r - worker only supports protocol 1, retrying with it", key)
+            return await asyncio.wait_for(communicate_legacy(path, key, wait), timeout)
+    except Exception:
+        logger.exception("request key=%r wait=%s - FAILED:", key, wait)
+        raise
+
+
+async def communicate(path, key, wait, payload, stale=False):
+    reader, writer = await asyncio.open_unix_connection("%s.sock" % path)
+    try:
+        try:
+            writer.write(HANDSHAKE + b"\n" + encode_request(1, key, wait, payload, stale=stale))
+            await writer.drain()
+            line = await reader.readline()
+        except (BrokenPipeError, ConnectionResetError) as exc:
+            raise LegacyWorker("Connection closed by worker before the handshake: %s" % exc)
+        if not line:
+            # a protocol 1 worker closes the connection right after reading the handshake
+            raise LegacyWorker("Connection closed by worker before the handshake")
+        hello = decode_line(line)
+        if hello.get("version") != VERSION:
+            raise ProtocolError("Unsupported protocol: %r" % hello)
+        if not wait:
+            return
+        line = await reader.readline()
+        logger.debug("request key=%r - got response %s", key, line)
+        if not line.endswith(b"\n"):
+            raise ProtocolError("Connection closed by worker")
+        message = decode_line(line)
+        message.pop("id")
+        size = message.pop("size", None)
+        if size is not None:
+            message["result"] = await reader.readexactly(size)
+        result = make_result(**message)
+        if isinstance(result, TaskFailed):
+            raise result
+        return result
+    finally:
+        writer.close()
+
+
+async def communicate_legacy(path, key, wait):
+    reader, writer = await asyncio.open_unix_connection("%s.sock" % path)
+    try:
+        writer.write(key + b"\n")
+        await writer.drain()
+        if not wait:
+            return
+        data = await reader.read()
+        if not data:
+            raise ProtocolError("Connection closed by worker")
+        result = make_result(**decode_line(data))
+        if isinstance(result, TaskFailed):
+            raise result
+        return result
+    finally:
+        writer.close()
+
+
+async def request_and_spawn(cli, path, key, wait=True, timeout=1, request_timeout=None, payload=None):
+    """
+    Asyncio variant of :func:`stampede.request_and_spawn`. The ``timeout`` is how long to wait for the daemon to
+    start, ``request_timeout`` is passed to :func:`request`.
+    """
+    await asyncio.get_event_loop().run_in_executor(None, spawn, cli, path, key, wait, timeout)
+    return await request(path, key, wait=wait, timeout=request_timeout, payload=payload)
+
+
+class AsyncioPoller(object):
+    """
+    Poller adapter that hands the worker's fds to an asyncio loop. Events are delivered through ``callback(fd, events)``
+    instead of ``poll()``.
+    """
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+        self.events = {}
+
+    def register(self, fd, events=READ):
+        self.events[fd] = 0
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        current = self.events[fd]
+        if events & READ and not current & READ:
+            self.loop.add_reader(fd, self.callback, fd, READ)
+        elif current & READ and not events & READ:
+            self.loop.remove_reader(fd)
+        if events & WRITE and not current & WRITE:
+            self.loop.add_writer(fd, self.callback, fd, WRITE)
+        elif current & WRITE and not events & WRITE:
+            self.loop.remove_writer(fd)
+        self.events[fd] = events
+
+    def unregister(self, fd):
+        self.modify(fd, 0)
+        del self.events[fd]
+
+    def close(self):
+        for fd in list(self.events):
+            self.unregister(fd)
+
+
+class AsyncStampedeWorker(StampedeWorker):
+    """
+    Worker that runs ``handle_task`` as a coroutine inside the daemon's asyncio loop instead of forking a process for
+    every task. Meant for I/O-bound tasks. Requests are collapsed and answered exactly like in :class:`StampedeWorker`;
+    the ``pid`` in the responses is the daemon's pid.
+
+    Tasks taking longer than :meth:`get_timeout` are cancelled and reported with ``TIMEOUT_EXIT_CODE``, like forked
+    tasks.
+    """
+    task_counter = itertools.count(1)
+
+    def __init__(self, path, *args, **kwargs):
+        if self.shards:
+            # every shard would need its own asyncio loop process and the tasks forwarding between them
+            raise RuntimeError("Shards are not supported by %s" % type(self).__name__)
+        super(AsyncStampedeWorker, self).__init__(path, *args, **kwargs)
+
+    async def handle_task(self, key, payload=None):
+        raise NotImplementedError()
+
+    @property
+    def running_count(self):
+        # timed out tasks are cancelled right away
+        return len(self.tasks)
+
+    def start_task(self, workspace):
+        if not workspace.started:
+            workspace.started = True
+            workspace.started_at = monotonic()
+            task_id = next(self.task_counter)
+            self.metrics.incr("tasks_started")
+            self.tasks[task_id] = workspace
+            self.loop.create_task(self.run_task(task_id, workspace))
+            logger.info("Started task %r for %s", task_id, workspace)
+
+    async def execute_task(self, key, payload=None):
+        exit_code = 255
+        result = None
+        # exceptions must be handled here: asyncio reraises SystemExit out of the loop if it escapes a coroutine
+        try:
+            if payload is None:
+                result = await self.handle_task(key)
+            else:
+                result = await self.handle_task(key, payload)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            raise
+        except SystemExit as exc:
+            exit_code = get_exit_code(exc)
+            logger.exception("Failed task key=%s", key)
+        except BaseException:
+            # like in a forked task anything else that escapes the task only fails it
+            logger.exception("Failed task key=%s", key)
+        else:
+            exit_code = 0
+            logger.info("Completed task key=%s", key)
+        return exit_code, result if isinstance(result, bytes) else None
+
+    async def run_task(self, task_id, workspace):
+        logger.info("Running task %r key=%s", task_id, workspace.key)
+        result = None
+        try:
+            exit_code, result = await asyncio.wait_for(self.execute_task(workspace.key, workspace.payload),
+                                                       self.get_timeout(workspace.key))
+        except asyncio.TimeoutError:
+            logger.error("Timed out task %r key=%s", task_id, workspace.key)
+            self.metrics.incr("tasks_timed_out")
+            exit_code = TIMEOUT_EXIT_CODE
+        self.finish_task(task_id, exit_code, os.getpid(), result)
+        self.flush_responses()
+        self.process_pending()
+
+    def send_handoff(self, conn):
+        # tasks run in this process so they can't be left behind
+        raise ProtocolError("Handoff is not supported by %s" % type(self).__name__)
+
+    def receive_handoff(self):
+        raise RuntimeError("Handoff is not supported by %s" % type(self).__name__)
+
+    def handle_tick(self):
+        self.log_state_periodically()
+        self.handle_timeouts()
+        self.compact_results(idle=not self.queues and not self.clients)
+        self.loop.call_later(self.next_timeout(), self.handle_tick)
+
+    def run(self):
+        self.warm_up()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        with closing(self.bind()) as self.requests_sock:
+            self.open_result_store()
+            self.poller = AsyncioPoller(self.loop, self.handle_event)
+            self.poller.register(self.requests_sock, READ)
+            self.start_metrics()
+            if self.state_signal:
+                self.loop.add_signal_handler(self.state_signal, self.log_state)
+            logger.info("Ready to accept requests on %r", self.socket_path)
+            try:
+                self.handle_tick()
+                self.loop.run_forever()
+            finally:
+                self.stop_metrics()
+                self.close_connections()
+                self.poller.close()
+                self.loop.close()
+                if self.results is not None:
+                    self.results.close()
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from collections import namedtuple
+from logging import getLogger
+from time import time
+
+logger = getLogger(__name__)
+
+Result = namedtuple("Result", ["exit_code", "pid", "finished", "payload"])
+
+
+class ResultCache(object):
+    """
+    Keeps the results of recently finished tasks for ``ttl`` seconds. At most ``max_size`` keys are kept, the least
+    recently used ones are evicted first (expired results are kept until then, see :meth:`peek`). With a ``store`` (see
+    :class:`stampede.store.ResultStore`) all the results are also written to disk and keys that aren't in memory are
+    looked up there.
+    """
+    def __init__(self, ttl, max_size=1000, store=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.store = store
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        entry = self.peek(key)
+        if entry is None or (now or time()) - entry.finished > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def peek(self, key):
+        """
+        Returns the last result for ``key`` even if it expired (or ``None``).
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+        if entry is not None:
+            self.add(key, entry)
+        return entry
+
+    def set(self, key, exit_code, pid, payload=None, finished=None):
+        entry = Result(exit_code, pid, finished or time(), payload)
+        self.entries.pop(key, None)
+        self.add(key, entry)
+        if self.store is not None:
+            try:
+                self.store.set(key, entry)
+            except Exception:
+                # eg: disk full - the result is still cached in memory
+                logger.exception("Failed to store the result for %r", key)
+
+    def add(self, key, entry):
+        self.entries[key] = entry
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "ResultCache(%s entries, hits=%s, misses=%s)" % (len(self.entries), self.hits, self.misses)
+
+    __repr__ = __str__
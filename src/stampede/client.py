@@ -1,8 +1,15 @@
-import json
+import array
+import errno
+import itertools
+import mmap
 import os
+import select
 import socket
+import threading
+from collections import deque
 from collections import namedtuple
 from contextlib import closing
+from contextlib import contextmanager
 from logging import getLogger
 from os.path import exists
 from time import sleep
@@ -12,69 +19,567 @@ from subprocess32 import DEVNULL
 from subprocess32 import Popen
 
 from .lock import FileLock
-from .utils import IS_PY2
+from .lock import SpawnLock
+from .protocol import HANDSHAKE
+from .protocol import VERSION
+from .protocol import ProtocolError
+from .protocol import decode_line
+from .protocol import encode_request
+from .protocol import encode_stats_request
+from .utils import READY_FD_ENV
+from .utils import close
 
 logger = getLogger(__name__)
 
 
 class TaskFailed(Exception):
-    def __init__(self, exit_code, pid):
+    def __init__(self, exit_code, pid, result=None, stale=None):
         self.exit_code = exit_code
         self.pid = pid
+        self.result = result
+        self.stale = stale
 
     def __str__(self):
         return "Task failed with exit_code: %s (pid: %s)" % (self.exit_code, self.pid)
 
 
-TaskSuccess = namedtuple("TaskSuccess", ["exit_code", "pid"])
+class ConnectionClosed(ProtocolError):
+    """
+    The worker closed the connection (eg: it exited or was restarted).
+    """
 
 
-def request(path, key, wait=True):
-    logger.info("request %r wait=%s", key, wait)
+class LegacyWorker(ProtocolError):
+    """
+    The worker closed the connection without answering the handshake: it only knows protocol 1.
+    """
+
+
+class TaskTimeout(TaskFailed):
+    def __str__(self):
+        return "Task timed out (pid: %s)" % self.pid
+
+
+class TaskSuccess(namedtuple("TaskSuccess", ["exit_code", "pid"])):
+    """
+    The ``result`` attribute holds the bytes returned by the task (or ``None``). It's not part of the tuple so
+    ``exit_code, pid = result`` still works. Results requested with ``shared=True`` are read-only :class:`mmap.mmap`
+    objects. For requests made with ``stale=True`` the ``stale`` attribute is the age (in seconds) of a previous
+    result that was returned instead of waiting for the task, otherwise it's ``None``.
+    """
+    def __new__(cls, exit_code, pid, result=None, stale=None):
+        self = super(TaskSuccess, cls).__new__(cls, exit_code, pid)
+        self.result = result
+        self.stale = stale
+        return self
+
+
+def check_key(key):
     if not isinstance(key, bytes):
         raise TypeError("key should be bytes, not %s!" % type(key).__name__)
     if b"\n" in key or b"\r" in key:
         raise ValueError("key must not have line endings!")
-    try:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        with closing(sock):
-            sock.settimeout(None)
-            sock.connect("%s.sock" % path)
-            if IS_PY2:
-                fh = sock.makefile(bufsize=0)
-            else:
-                fh = sock.makefile("rwb", buffering=0)
-            fh.write(b"%s\n" % key)
-            if not wait:
-                return
-            line = fh.readline()
-            logger.debug("request key=%r - got response %s", key, line)
-            result = json.loads(line.decode('ascii'))
-            if result["exit_code"]:
-                raise TaskFailed(**result)
+
+
+def is_disconnect(exc):
+    if isinstance(exc, ConnectionClosed):
+        return True
+    return isinstance(exc, socket.error) and exc.errno in (errno.EPIPE, errno.ECONNRESET)
+
+
+def make_result(exit_code, pid, result=None, stale=None, timeout=False):
+    if timeout:
+        return TaskTimeout(exit_code, pid, result, stale)
+    elif exit_code:
+        return TaskFailed(exit_code, pid, result, stale)
+    else:
+        return TaskSuccess(exit_code, pid, result, stale)
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.completed = False
+        self.result = self.error = None
+        self.followers = 0
+
+
+class SingleFlight(object):
+    """
+    Lets concurrent callers (threads) making the same call share a single execution: the first one runs it and the
+    others wait for it and get the same result (or exception).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def call(self, key, func, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
             else:
-                return TaskSuccess(**result)
+                flight.followers += 1
+        if leader:
+            try:
+                flight.result = func(*args)
+                flight.completed = True
+            except Exception as exc:
+                flight.error = exc
+                flight.completed = True
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+                if flight.followers:
+                    logger.debug("SingleFlight.call %r - shared with %s followers", key, flight.followers)
+            return flight.result
+        flight.done.wait()
+        if not flight.completed:
+            # the leader got interrupted (eg: KeyboardInterrupt), do it ourselves
+            return func(*args)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+
+flights = SingleFlight()
+
+
+def request(path, key, wait=True, payload=None, shared=False, stale=False, singleflight=False):
+    """
+    With ``shared=True`` the worker passes the result as a file descriptor instead of sending a copy of it - all the
+    clients waiting on the same task map the same memory.
+
+    With ``stale=True`` the worker answers right away with the last result of the key, if it has one (even if it
+    expired, see ``result_ttl``), and runs the task again in the background.
+
+    With ``singleflight=True`` concurrent calls (from other threads) for the same key share a single request to the
+    worker and all get the same result object (or exception). The payload of the first call is used, like the worker
+    does for collapsed requests.
+    """
+    logger.info("request %r wait=%s", key, wait)
+    check_key(key)
+    if singleflight and wait:
+        return flights.call((path, key, shared, stale), send_request, path, key, wait, payload, shared, stale)
+    return send_request(path, key, wait, payload, shared, stale)
+
+
+def send_request(path, key, wait, payload, shared, stale):
+    try:
+        try:
+            with closing(ClientConnection(path)) as conn:
+                result = conn.request(key, wait, payload, shared, stale)
+        except LegacyWorker:
+            if payload is not None or shared or stale:
+                raise
+            logger.info("request key=%r - worker only supports protocol 1, retrying with it", key)
+            result = legacy_request(path, key, wait)
+        logger.debug("request key=%r - got response %s", key, result)
+        return result
     except Exception:
         logger.exception("request key=%r wait=%s - FAILED:", key, wait)
         raise
 
 
-def request_and_spawn(cli, path, key, wait=True, timeout=1):
+def legacy_request(path, key, wait=True, timeout=None):
+    """
+    Makes a protocol 1 request, for workers started by an older version (daemons outlive the deploys of their clients).
+    There's no result, only the exit status.
+    """
+    with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+        sock.settimeout(timeout)
+        sock.connect("%s.sock" % path)
+        sock.sendall(key + b"\n")
+        if not wait:
+            return
+        chunks = []
+        chunk = sock.recv(4096)
+        while chunk:
+            chunks.append(chunk)
+            chunk = sock.recv(4096)
+    if not chunks:
+        raise ConnectionClosed("Connection closed by worker")
+    result = make_result(**decode_line(b"".join(chunks)))
+    if isinstance(result, TaskFailed):
+        raise result
+    return result
+
+
+def stats(path, timeout=None):
+    """
+    Returns the worker's metrics: a dict with "counters", "gauges" and "histograms".
+    """
+    with closing(ClientConnection(path, timeout)) as conn:
+        return conn.stats()
+
+
+def request_and_spawn(cli, path, key, wait=True, timeout=1, payload=None):
+    spawn(cli, path, key, wait, timeout)
+    return request(path, key, wait=wait, payload=payload)
+
+
+def is_running(path, socket_path):
+    """
+    Checks if there's a daemon bound to ``socket_path`` (the socket could be stale - left by a daemon that died).
+    """
+    if not exists(socket_path):
+        return False
+    lock = FileLock(path)
+    if lock.acquire():
+        lock.release()
+        return False
+    return True
+
+
+def spawn(cli, path, key, wait, timeout=1):
+    """
+    Starts the daemon if it's not running and waits (up to ``timeout`` seconds) until it accepts requests. Spawners
+    are serialized with a :class:`~stampede.lock.SpawnLock` so concurrent cold starts launch a single daemon.
+    """
     socket_path = "%s.sock" % path
-    if exists(socket_path):
+    if is_running(path, socket_path):
         logger.info("request_and_spawn key=%r wait=%s - socket already exists", key, wait)
-        lock = FileLock(path)
-        if lock.acquire():
-            logger.info("request_and_spawn key=%r - got lock, spawning daemon ...", key)
-            lock.release()
+        return socket_path
+    with SpawnLock(path):
+        # someone else might have spawned it while we were waiting for the lock
+        if is_running(path, socket_path):
+            logger.info("request_and_spawn key=%r wait=%s - daemon was just spawned", key, wait)
+        elif exists(socket_path):
+            logger.info("request_and_spawn key=%r wait=%s - stale socket, spawning daemon ...", key, wait)
             os.unlink(socket_path)
-            Popen(cli, stdin=DEVNULL, close_fds=True)
-    else:
-        logger.info("request_and_spawn key=%r wait=%s - no socket, spawning daemon ...", key, wait)
-        Popen(cli, stdin=DEVNULL, close_fds=True)
+            start_daemon(cli, socket_path, timeout)
+        else:
+            logger.info("request_and_spawn key=%r wait=%s - no socket, spawning daemon ...", key, wait)
+            start_daemon(cli, socket_path, timeout)
+    return socket_path
 
-    t = time()
-    while not exists(socket_path) and time() - t < timeout:
+
+def start_daemon(cli, socket_path, timeout):
+    """
+    Runs ``cli`` and waits for it to write to the pipe passed in the ``STAMPEDE_READY_FD`` environment variable
+    (:meth:`StampedeWorker.notify_ready <stampede.worker.StampedeWorker.notify_ready>` does that right after the socket
+    is bound).
+    """
+    deadline = time() + timeout
+    ready_fd, notify_fd = os.pipe()
+    try:
+        try:
+            env = dict(os.environ)
+            env[READY_FD_ENV] = str(notify_fd)
+            Popen(cli, stdin=DEVNULL, close_fds=True, pass_fds=(notify_fd,), env=env)
+        finally:
+            os.close(notify_fd)
+        if select.select([ready_fd], [], [], timeout)[0] and os.read(ready_fd, 1):
+            return
+    finally:
+        os.close(ready_fd)
+    # the daemon exited without binding (eg: it lost the instance lock to one started by other means) or timed out
+    logger.info("start_daemon cli=%r - daemon didn't signal readiness, waiting for the socket ...", cli)
+    while not exists(socket_path) and time() < deadline:
         sleep(0.01)
 
-    return request(path, key, wait=wait)
+
+def request_many(path, keys, wait=True, timeout=None):
+    """
+    Requests all the ``keys`` over a single connection. With ``wait=True`` it returns an iterator that yields
+    ``(key, result)`` tuples as the tasks complete - failed tasks are yielded as :exc:`TaskFailed` instances, not raised.
+    """
+    keys = list(keys)
+    logger.info("request_many %s keys wait=%s", len(keys), wait)
+    conn = ClientConnection(path, timeout)
+    try:
+        requests = conn.send_many(keys, wait)
+    except Exception:
+        logger.exception("request_many wait=%s - FAILED:", wait)
+        conn.close()
+        raise
+    if wait:
+        return iter_and_close(conn, requests)
+    else:
+        conn.close()
+
+
+def iter_and_close(conn, requests):
+    with closing(conn):
+        for item in conn.iter_results(requests):
+            yield item
+
+
+class ClientConnection(object):
+    """
+    A persistent (protocol 2) connection to the worker. Many requests can be in flight on the same connection, use
+    ``send`` and ``recv`` for pipelining or ``request`` for a single roundtrip. Not thread-safe.
+    """
+    read_size = 65536
+    max_fds = 16
+
+    def __init__(self, path, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(timeout)
+            self.sock.connect("%s.sock" % path)
+            self.sock.sendall(HANDSHAKE + b"\n")
+        except Exception:
+            self.sock.close()
+            raise
+        self.rbuf = bytearray()
+        self.received = 0
+        self.fds = deque()
+        self.greeted = False
+        self.counter = itertools.count(1)
+        self.inflight = set()
+        self.results = {}
+
+    def send(self, key, wait=True, payload=None, shared=False, stale=False):
+        check_key(key)
+        if shared and not hasattr(self.sock, "recvmsg"):
+            raise RuntimeError("Shared results require socket.recvmsg.")
+        request_id = next(self.counter)
+        try:
+            self.sock.sendall(encode_request(request_id, key, wait, payload, shared, stale))
+        except socket.error as exc:
+            # a protocol 1 worker closes the connection right after reading the handshake
+            if self.greeted or exc.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            raise LegacyWorker("Connection closed by worker before the handshake: %s" % exc)
+        if wait:
+            self.inflight.add(request_id)
+        return request_id
+
+    def send_many(self, keys, wait=True):
+        """
+        Sends all the requests in one go. Returns a ``{request_id: key}`` dict.
+        """
+        requests = {}
+        for key in keys:
+            check_key(key)
+            requests[next(self.counter)] = key
+        self.sock.sendall(b"".join(encode_request(request_id, key, wait) for request_id, key in requests.items()))
+        if wait:
+            self.inflight.update(requests)
+        return requests
+
+    def fill(self):
+        # the worker might send file descriptors anytime so they must be always received (a plain recv drops them)
+        if hasattr(self.sock, "recvmsg"):
+            data, ancillary, _, _ = self.sock.recvmsg(self.read_size, socket.CMSG_SPACE(self.max_fds * 4),
+                                                      getattr(socket, "MSG_CMSG_CLOEXEC", 0))
+            for level, kind, fds in ancillary:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    received = array.array("i")
+                    received.frombytes(fds[:len(fds) - len(fds) % received.itemsize])
+                    self.fds.extend(received)
+        else:
+            data = self.sock.recv(self.read_size)
+        if not data:
+            raise ConnectionClosed("Connection closed by worker")
+        self.received += len(data)
+        self.rbuf.extend(data)
+
+    def readline(self):
+        pos = self.rbuf.find(b"\n")
+        while pos == -1:
+            self.fill()
+            pos = self.rbuf.find(b"\n")
+        line = bytes(self.rbuf[:pos + 1])
+        del self.rbuf[:pos + 1]
+        return decode_line(line)
+
+    def read_exactly(self, size):
+        while len(self.rbuf) < size:
+            self.fill()
+        data = bytes(self.rbuf[:size])
+        del self.rbuf[:size]
+        return data
+
+    def read_shared(self, size):
+        if not self.fds:
+            raise ProtocolError("Missing file descriptor for shared result")
+        fd = self.fds.popleft()
+        try:
+            return mmap.mmap(fd, size, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+    def read_hello(self):
+        try:
+            while b"\n" not in self.rbuf:
+                self.fill()
+        except socket.error as exc:
+            if self.rbuf or exc.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            raise LegacyWorker("Connection closed by worker before the handshake: %s" % exc)
+        except ConnectionClosed:
+            if self.rbuf:
+                raise
+            raise LegacyWorker("Connection closed by worker before the handshake")
+        hello = self.readline()
+        if hello.get("version") != VERSION:
+            raise ProtocolError("Unsupported protocol: %r" % hello)
+        self.greeted = True
+
+    def recv(self):
+        """
+        Returns the ``(request_id, result)`` of the next completed request. Failed tasks are returned as
+        :exc:`TaskFailed` instances, not raised.
+        """
+        if not self.greeted:
+            self.read_hello()
+        message = self.readline()
+        request_id = message.pop("id")
+        self.inflight.discard(request_id)
+        if "stats" in message:
+            return request_id, message["stats"]
+        size = message.pop("size", None)
+        if size is not None:
+            message["result"] = self.read_exactly(size)
+        size = message.pop("shared", None)
+        if size is not None:
+            message["result"] = self.read_shared(size)
+        return request_id, make_result(**message)
+
+    def wait(self, request_id):
+        while request_id not in self.results:
+            completed_id, result = self.recv()
+            self.results[completed_id] = result
+        result = self.results.pop(request_id)
+        if isinstance(result, TaskFailed):
+            raise result
+        return result
+
+    def request(self, key, wait=True, payload=None, shared=False, stale=False):
+        request_id = self.send(key, wait, payload, shared, stale)
+        if wait:
+            return self.wait(request_id)
+        elif not self.greeted:
+            # otherwise a protocol 1 worker would just drop the request
+            self.read_hello()
+
+    def stats(self):
+        request_id = next(self.counter)
+        self.sock.sendall(encode_stats_request(request_id))
+        self.inflight.add(request_id)
+        return self.wait(request_id)
+
+    def iter_results(self, requests):
+        """
+        Yields ``(key, result)`` for the given ``{request_id: key}`` dict as the tasks complete.
+        """
+        requests = dict(requests)
+        for request_id in list(requests):
+            if request_id in self.results:
+                yield requests.pop(request_id), self.results.pop(request_id)
+        while requests:
+            request_id, result = self.recv()
+            if request_id in requests:
+                yield requests.pop(request_id), result
+            else:
+                self.results[request_id] = result
+
+    def close(self):
+        close(self.sock, *self.fds)
+        self.fds.clear()
+
+
+class Client(object):
+    """
+    Thread-safe client that keeps up to ``pool_size`` idle persistent connections around for reuse. With
+    ``singleflight=True`` concurrent requests for the same key share a single request to the worker (see
+    :func:`request`).
+    """
+    def __init__(self, path, pool_size=8, timeout=None, singleflight=False):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.flights = SingleFlight() if singleflight else None
+
+    @contextmanager
+    def connection(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = ClientConnection(self.path, self.timeout)
+        try:
+            yield conn
+        except TaskFailed:
+            self.release(conn)
+            raise
+        except Exception:
+            conn.close()
+            raise
+        else:
+            self.release(conn)
+
+    def call(self, func, *args):
+        """
+        Runs ``func(conn, *args)`` on a pooled connection. An idle connection might have been closed by the worker (eg:
+        the worker was restarted) so if it fails before anything was received the call is retried once on a new
+        connection.
+        """
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = ClientConnection(self.path, self.timeout)
+            received = conn.received
+            try:
+                result = func(conn, *args)
+            except TaskFailed:
+                self.release(conn)
+                raise
+            except Exception as exc:
+                conn.close()
+                if reused and conn.received == received and is_disconnect(exc):
+                    logger.info("Client.call - pooled connection was closed by the worker (%s), reconnecting", exc)
+                    conn = None
+                    reused = False
+                    continue
+                raise
+            else:
+                self.release(conn)
+                return result
+
+    def release(self, conn):
+        if not conn.inflight:
+            with self.lock:
+                if len(self.idle) < self.pool_size:
+                    self.idle.append(conn)
+                    return
+        conn.close()
+
+    def request(self, key, wait=True, payload=None, shared=False, stale=False):
+        logger.info("Client.request %r wait=%s", key, wait)
+        if self.flights is not None and wait:
+            check_key(key)
+            return self.flights.call((key, shared, stale), self.send_request, key, wait, payload, shared, stale)
+        return self.send_request(key, wait, payload, shared, stale)
+
+    def send_request(self, key, wait, payload, shared, stale):
+        try:
+            return self.call(ClientConnection.request, key, wait, payload, shared, stale)
+        except LegacyWorker:
+            if payload is not None or shared or stale:
+                raise
+            logger.info("Client.request key=%r - worker only supports protocol 1, retrying with it", key)
+            return legacy_request(self.path, key, wait, self.timeout)
+
+    def stats(self):
+        return self.call(ClientConnection.stats)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
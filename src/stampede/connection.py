@@ -0,0 +1,198 @@
+import array
+import errno
+import pwd
+import socket
+import sys
+from collections import deque
+from logging import getLogger
+
+from .utils import IS_PY2
+from .utils import close
+
+logger = getLogger(__name__)
+
+RETRY_ERRNOS = errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR
+
+
+def would_block(exc):
+    if exc.errno in RETRY_ERRNOS:
+        if IS_PY2:
+            sys.exc_clear()
+        return True
+    return False
+
+
+class RequestTooLong(Exception):
+    pass
+
+
+usernames = {}
+
+
+def get_username(uid):
+    if uid not in usernames:
+        try:
+            usernames[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            usernames[uid] = str(uid)
+            if IS_PY2:
+                sys.exc_clear()
+    return usernames[uid]
+
+
+class ClientId(object):
+    """
+    Formats as ``user:pid`` - but only when actually needed (eg: when a log message is emitted).
+    """
+    __slots__ = "uid", "pid", "label"
+
+    def __init__(self, uid, pid):
+        self.uid = uid
+        self.pid = pid
+        self.label = None
+
+    def __str__(self):
+        if self.label is None:
+            self.label = "%s:%s" % (get_username(self.uid), self.pid)
+        return self.label
+
+    __repr__ = __str__
+
+
+class Connection(object):
+    """
+    A non-blocking client connection with incremental line parsing and a buffered writer. Nothing in here ever blocks
+    the worker loop: reads return whatever complete lines are available and writes are queued until the socket is
+    writable.
+    """
+    read_size = 65536
+    max_line_length = 65536
+
+    def __init__(self, sock, client_id, deadline=None):
+        sock.setblocking(False)
+        self.sock = sock
+        self.client_id = client_id
+        self.deadline = deadline
+        self.reading = True
+        self.events = 0
+        self.version = 1
+        self.inflight = 0
+        self.rbuf = bytearray()
+        self.message = None
+        self.wbuf = bytearray()
+        self.wfds = deque()
+        self.written = 0
+        self.shared = set()
+        self.eof = False
+        self.closing = False
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def fill(self):
+        """
+        Reads what's available into the buffer. Sets ``eof`` if the client closed the connection.
+        """
+        try:
+            data = self.sock.recv(self.read_size)
+        except socket.error as exc:
+            if would_block(exc):
+                return
+            raise
+        if data:
+            self.rbuf.extend(data)
+        else:
+            self.eof = True
+
+    def readline(self):
+        """
+        Returns the next complete line (without line endings) or ``None``. On EOF the incomplete line is returned.
+        """
+        pos = self.rbuf.find(b"\n")
+        if pos == -1:
+            if len(self.rbuf) > self.max_line_length:
+                raise RequestTooLong("Line exceeds %s bytes" % self.max_line_length)
+            if self.eof and self.rbuf:
+                pos = len(self.rbuf)
+            else:
+                return None
+        line = bytes(self.rbuf[:pos])
+        del self.rbuf[:pos + 1]
+        return line.rstrip(b"\r")
+
+    def read_exactly(self, size):
+        """
+        Returns the next ``size`` bytes or ``None`` if they didn't arrive yet.
+        """
+        if len(self.rbuf) < size:
+            return None
+        data = bytes(self.rbuf[:size])
+        del self.rbuf[:size]
+        return data
+
+    def write(self, data, files=()):
+        """
+        Queues ``data``. The ``files`` (objects with a ``fileno()``) are sent along with the first byte of ``data`` and
+        kept open until then.
+        """
+        if files:
+            self.wfds.append((self.written + len(self.wbuf), files))
+        self.wbuf.extend(data)
+
+    def flush(self):
+        """
+        Sends as much as the socket accepts. Returns ``True`` if everything was sent.
+        """
+        while self.wbuf:
+            data = self.wbuf
+            ancillary = None
+            if self.wfds:
+                offset, files = self.wfds[0]
+                if offset == self.written:
+                    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fh.fileno() for fh in files]))]
+                    if len(self.wfds) > 1:
+                        data = self.wbuf[:self.wfds[1][0] - offset]
+                else:
+                    data = self.wbuf[:offset - self.written]
+            try:
+                if ancillary:
+                    sent = self.sock.sendmsg([data], ancillary)
+                else:
+                    sent = self.sock.send(data)
+            except socket.error as exc:
+                if would_block(exc):
+                    return False
+                raise
+            if ancillary and sent:
+                self.wfds.popleft()
+            del self.wbuf[:sent]
+            self.written += sent
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.wfds.clear()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error as exc:
+                if exc.errno != errno.ENOTCONN:
+                    logger.debug("Failed to shutdown %s: %s", self.client_id, exc)
+                if IS_PY2:
+                    sys.exc_clear()
+            close(self.sock)
+
+    def detach(self):
+        """
+        Closes the fd without shutting down the socket (for connections that were passed to another process).
+        """
+        if not self.closed:
+            self.closed = True
+            self.wfds.clear()
+            close(self.sock)
+
+    def __str__(self):
+        return str(self.client_id)
+
+    __repr__ = __str__
@@ -0,0 +1,302 @@
+import errno
+import multiprocessing
+import os
+import signal
+import struct
+import sys
+from collections import deque
+from logging import getLogger
+from time import sleep
+from time import time
+
+import signalfd
+
+from .shared import SharedResult
+from .shared import create_memfd
+from .utils import IS_PY2
+from .utils import cloexec
+from .utils import close
+from .utils import collect_sigchld
+from .utils import monotonic
+from .utils import set_nonblocking
+from .utils import write_all
+
+logger = getLogger(__name__)
+
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+
+# what pool calls write to the wakeup pipe: the id of a task that just started or 0 (just wake up the loop)
+WAKEUP = struct.Struct("<q")
+
+
+def send_wakeup(fd, task_id=0):
+    while True:
+        try:
+            os.write(fd, WAKEUP.pack(task_id))
+            return
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+            if IS_PY2:
+                sys.exc_clear()
+            if not task_id:
+                # the loop has plenty of wakeups to read already
+                return
+            sleep(0.001)
+
+
+class ForkExecutor(object):
+    """
+    Runs every task in a forked child. Completions are collected from a ``SIGCHLD`` signalfd. Task results are written by
+    the child to a pipe that the worker loop reads while the task runs, or to a memfd if the worker has
+    ``shared_results`` enabled. Tasks that time out are killed with ``SIGKILL``.
+    """
+    read_size = 65536
+    reports_start = False  # tasks start running right away
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.fd = None
+        self.results = {}
+        self.cancelled = set()
+        self.forked_at = None
+
+    def start(self):
+        child_fd = signalfd.signalfd(-1, [signal.SIGCHLD], signalfd.SFD_NONBLOCK | signalfd.SFD_CLOEXEC)
+        self.fd = os.fdopen(child_fd, "rb")
+        signalfd.sigprocmask(signalfd.SIG_BLOCK, [signal.SIGCHLD])
+
+    def submit(self, key, payload=None):
+        if self.worker.shared_results:
+            result_fd = child_result_fd = create_memfd()
+        else:
+            result_fd, child_result_fd = os.pipe()
+        self.forked_at = time()
+        try:
+            pid = os.fork()
+        except OSError:
+            close(*set((result_fd, child_result_fd)))
+            raise
+        if pid:
+            if child_result_fd == result_fd:
+                self.results[pid] = result_fd, None
+            else:
+                os.close(child_result_fd)
+                set_nonblocking(cloexec(result_fd))
+                self.results[pid] = result_fd, bytearray()
+                self.worker.add_reader(result_fd, lambda: self.read_result(pid))
+            return pid
+        else:
+            if child_result_fd != result_fd:
+                os.close(result_fd)
+            if self.worker.state_signal:
+                # the worker blocks it (it's read from a signalfd) but the task might want to handle it
+                signalfd.sigprocmask(signalfd.SIG_UNBLOCK, [self.worker.state_signal])
+            logger.info("Running task %r key=%s (forked in %.6fs)", os.getpid(), key, time() - self.forked_at)
+            exit_code = 255
+            try:
+                exit_code, result = self.worker.execute_task(key, payload)
+                if result:
+                    write_all(child_result_fd, result)
+            finally:
+                os._exit(exit_code)
+
+    def read_result(self, pid):
+        fd, buf = self.results[pid]
+        try:
+            while True:
+                data = os.read(fd, self.read_size)
+                if not data:
+                    self.worker.remove_reader(fd)
+                    return
+                buf.extend(data)
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+            if IS_PY2:
+                sys.exc_clear()
+
+    def cancel(self, task_id):
+        """
+        Kills the task and returns its pid. Its completion is not reported.
+        """
+        try:
+            os.kill(task_id, signal.SIGKILL)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+            if IS_PY2:
+                sys.exc_clear()
+        self.cancelled.add(task_id)
+        self.pop_result(task_id)
+        return task_id
+
+    def collect(self):
+        for pid, exit_code in collect_sigchld(self.fd).items():
+            if pid in self.cancelled:
+                self.cancelled.discard(pid)
+                continue
+            yield pid, exit_code, pid, self.pop_result(pid)
+
+    def pop_result(self, pid):
+        if pid not in self.results:
+            return None
+        fd, buf = self.results[pid]
+        if buf is None:
+            del self.results[pid]
+            return SharedResult.from_fd(fd)
+        if fd in self.worker.handlers:
+            # the child is gone so whatever it wrote is already in the pipe
+            self.read_result(pid)
+            if fd in self.worker.handlers:
+                self.worker.remove_reader(fd)
+        del self.results[pid]
+        os.close(fd)
+        return bytes(buf) if buf else None
+
+    def shutdown(self):
+        close(self.fd, *[fd for fd, _ in self.results.values()])
+
+
+class PoolExecutor(object):
+    """
+    Base for executors backed by a :mod:`concurrent.futures` pool. Completions are queued by the pool's callbacks and
+    the worker loop is woken up through a pipe. Calls can wait in the pool's queue so they write their task id to the
+    pipe when they actually start (the worker starts the task's deadline then).
+    """
+    reports_start = True
+
+    def __init__(self, worker, max_workers=None):
+        if futures is None:
+            raise RuntimeError("%s requires the concurrent.futures module." % type(self).__name__)
+        self.worker = worker
+        self.max_workers = max_workers or worker.max_tasks
+        self.pool = None
+        self.fd = None
+        self.wakeup_fd = None
+        self.completed = deque()
+        self.futures = {}
+        self.cancelled = set()
+        self.counter = 0
+
+    def create_pool(self):
+        raise NotImplementedError()
+
+    def start(self):
+        self.fd, self.wakeup_fd = os.pipe()
+        for fd in self.fd, self.wakeup_fd:
+            cloexec(fd)
+            set_nonblocking(fd)
+        self.pool = self.create_pool()
+
+    def submit(self, key, payload=None):
+        self.counter += 1
+        task_id = self.counter
+        future = self.futures[task_id] = self.submit_call(task_id, key, payload)
+        future.add_done_callback(lambda future: self.complete(task_id, future))
+        return task_id
+
+    def submit_call(self, task_id, key, payload):
+        raise NotImplementedError()
+
+    def complete(self, task_id, future):
+        # called from pool threads: deque.append is threadsafe and the write just wakes up the worker loop
+        if future.cancelled():
+            return
+        try:
+            exit_code, pid, result = future.result()
+        except Exception as exc:
+            logger.error("Pool failed to run task %r: %r", task_id, exc)
+            exit_code, pid, result = 255, os.getpid(), None
+        self.completed.append((task_id, exit_code, pid, result))
+        send_wakeup(self.wakeup_fd)
+
+    def cancel(self, task_id):
+        """
+        Cancels the call if it didn't start yet. A running call can't be stopped: it's not reported but it's kept in
+        ``cancelled`` until it returns (it still takes a place in the pool).
+        """
+        future = self.futures.pop(task_id)
+        if not future.cancel():
+            self.cancelled.add(task_id)
+        return os.getpid()
+
+    def collect(self):
+        data = b""
+        try:
+            while True:
+                chunk = os.read(self.fd, 4096)
+                if not chunk:
+                    break
+                data += chunk
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+            if IS_PY2:
+                sys.exc_clear()
+        now = monotonic()
+        for offset in range(0, len(data) - len(data) % WAKEUP.size, WAKEUP.size):
+            task_id, = WAKEUP.unpack_from(data, offset)
+            if task_id in self.futures:
+                self.worker.task_started(task_id, now)
+        while self.completed:
+            completion = self.completed.popleft()
+            if completion[0] in self.cancelled:
+                self.cancelled.discard(completion[0])
+            else:
+                self.futures.pop(completion[0], None)
+                yield completion
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+        close(self.fd, self.wakeup_fd)
+
+
+class ThreadPoolExecutor(PoolExecutor):
+    """
+    Runs tasks in a thread pool inside the daemon. Good for I/O-bound tasks that release the GIL.
+    The ``pid`` reported for tasks is the daemon's. Clients of a task that times out are answered right away but the
+    thread can't be stopped (it still counts for ``max_tasks`` until it returns).
+    """
+    def create_pool(self):
+        return futures.ThreadPoolExecutor(self.max_workers or 8)
+
+    def submit_call(self, task_id, key, payload):
+        return self.pool.submit(self.call, task_id, key, payload)
+
+    def call(self, task_id, key, payload):
+        send_wakeup(self.wakeup_fd, task_id)
+        exit_code, result = self.worker.execute_task(key, payload)
+        return exit_code, os.getpid(), result
+
+
+class ProcessPoolExecutor(PoolExecutor):
+    """
+    Runs tasks in a pool of reusable forked processes. The pool processes are forked from the daemon so they get the
+    worker instance without pickling it. Like with :class:`ThreadPoolExecutor` tasks that time out can't be stopped.
+    """
+    def create_pool(self):
+        global pool_worker, pool_wakeup_fd
+        pool_worker = self.worker
+        pool_wakeup_fd = self.wakeup_fd
+        kwargs = {}
+        if not IS_PY2:
+            kwargs['mp_context'] = multiprocessing.get_context('fork')
+        return futures.ProcessPoolExecutor(self.max_workers, **kwargs)
+
+    def submit_call(self, task_id, key, payload):
+        return self.pool.submit(execute_in_pool, task_id, key, payload)
+
+
+pool_worker = None
+pool_wakeup_fd = None
+
+
+def execute_in_pool(task_id, key, payload):
+    # the pool processes are forked from the daemon so they have the pipe too
+    send_wakeup(pool_wakeup_fd, task_id)
+    exit_code, result = pool_worker.execute_task(key, payload)
+    return exit_code, os.getpid(), result
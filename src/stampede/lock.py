@@ -2,6 +2,8 @@ import fcntl
 import os
 from logging import getLogger
 
+from .utils import cloexec
+
 logger = getLogger(__name__)
 
 
@@ -14,11 +16,11 @@ class FileLock(object):
         self.lock_path = '%s.lock' % path
         self.fd = None
 
-    def acquire(self):
+    def acquire(self, blocking=False):
 
         try:
             fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
-            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.lockf(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
         except IOError:
             logger.debug('FileLock(%s).acquire() => False (already locked)', self.lock_path)
             os.close(fd)
@@ -41,3 +43,33 @@ class FileLock(object):
         self.fd = None
 
     __exit__ = release
+
+
+class SpawnLock(object):
+    """
+    Blocking lock held while starting the daemon, so concurrent spawners don't start more than one. Unlike
+    :class:`FileLock` this uses ``flock`` (locks belong to the open file, not to the process) so it also works between
+    threads of the same process.
+    """
+    def __init__(self, path):
+        self.lock_path = '%s.spawn.lock' % path
+        self.fd = None
+
+    def acquire(self):
+        fd = cloexec(os.open(self.lock_path, os.O_RDWR | os.O_CREAT))
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except Exception:
+            os.close(fd)
+            raise
+        self.fd = fd
+        return self
+
+    __enter__ = acquire
+
+    def release(self, _type=None, _value=None, _traceback=None):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    __exit__ = release
@@ -0,0 +1,130 @@
+from bisect import bisect_left
+from time import time
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class Histogram(object):
+    """
+    Cumulative-friendly histogram with fixed bucket upper bounds (the last, implicit bucket is +Inf).
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": [[bound, total] for bound, total in self.cumulative()],
+        }
+
+
+class Metrics(object):
+    """
+    In-memory counters and histograms for the worker loop. Updates are just integer increments and a bisect so they're
+    cheap enough for the hot path. Gauges are computed on demand by the ``gauges`` callable.
+    """
+    counter_names = (
+        "accepts",
+        "requests",
+        "collapsed_requests",
+        "cache_hits",
+        "stale_responses",
+        "held_tasks",
+        "saved_runs",
+        "tasks_started",
+        "tasks_not_started",
+        "forwarded_tasks",
+        "tasks_failed",
+        "tasks_timed_out",
+        "tasks_completed",
+        "responses",
+    )
+    histogram_buckets = {
+        "submit_seconds": LATENCY_BUCKETS,
+        "task_seconds": LATENCY_BUCKETS,
+        "fanout_seconds": LATENCY_BUCKETS,
+        "task_clients": SIZE_BUCKETS,
+    }
+    descriptions = {
+        "accepts": "Accepted connections.",
+        "requests": "Requests received (all protocols).",
+        "collapsed_requests": "Requests that joined an already queued or running task.",
+        "cache_hits": "Requests answered from the result cache.",
+        "stale_responses": "Requests answered with an expired or outdated result while the task runs again.",
+        "held_tasks": "Tasks held for the coalescing delay before starting.",
+        "saved_runs": "Runs avoided by holding tasks (estimated from the duration of the run that was held).",
+        "tasks_started": "Tasks submitted to the executor.",
+        "tasks_not_started": "Tasks the executor failed to start (their clients get a 255 exit code).",
+        "forwarded_tasks": "Tasks forwarded to the shard that owns their key.",
+        "tasks_failed": "Tasks that completed with a non-zero exit code.",
+        "tasks_timed_out": "Tasks killed for running longer than their timeout (they also count as failed).",
+        "tasks_completed": "Tasks that completed.",
+        "responses": "Responses queued for clients.",
+        "submit_seconds": "Time spent submitting a task to the executor (fork latency for the fork executor).",
+        "task_seconds": "Time from task start to completion.",
+        "fanout_seconds": "Time spent queueing the responses of a completed task for all its clients.",
+        "task_clients": "Number of clients waiting on a completed task (the collapse ratio).",
+    }
+
+    def __init__(self, gauges=None):
+        self.started = time()
+        self.gauges = gauges
+        self.counters = dict.fromkeys(self.counter_names, 0)
+        self.histograms = dict((name, Histogram(buckets)) for name, buckets in self.histogram_buckets.items())
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def snapshot(self):
+        gauges = {"uptime_seconds": time() - self.started}
+        if self.gauges:
+            gauges.update(self.gauges())
+        return {
+            "counters": dict(self.counters),
+            "gauges": gauges,
+            "histograms": dict((name, histogram.as_dict()) for name, histogram in self.histograms.items()),
+        }
+
+    def format_prometheus(self, prefix="stampede_"):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = "%s%s_total" % (prefix, name)
+            lines.append("# HELP %s %s" % (metric, self.descriptions.get(name, name)))
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s %s" % (metric, value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            metric = "%s%s" % (prefix, name)
+            lines.append("# TYPE %s gauge" % metric)
+            lines.append("%s %s" % (metric, value))
+        for name, histogram in sorted(self.histograms.items()):
+            metric = "%s%s" % (prefix, name)
+            lines.append("# HELP %s %s" % (metric, self.descriptions.get(name, name)))
+            lines.append("# TYPE %s histogram" % metric)
+            for bound, total in histogram.cumulative():
+                lines.append('%s_bucket{le="%s"} %s' % (metric, bound, total))
+            lines.append("%s_sum %s" % (metric, histogram.sum))
+            lines.append("%s_count %s" % (metric, histogram.count))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,114 @@
+import errno
+import select
+import sys
+from logging import getLogger
+
+from .utils import IS_PY2
+from .utils import cloexec
+
+logger = getLogger(__name__)
+
+READ = 0x001
+WRITE = 0x004
+ERROR = 0x008 | 0x010
+# for fds shared by several processes: only one of them is woken up for an event (Linux 4.5+)
+EXCLUSIVE = getattr(select, "EPOLLEXCLUSIVE", 0)
+
+
+def fileno_of(fd):
+    return fd if isinstance(fd, int) else fd.fileno()
+
+
+def interrupted(exc):
+    if exc.args and exc.args[0] == errno.EINTR:
+        if IS_PY2:
+            sys.exc_clear()
+        return True
+    return False
+
+
+class SelectPoller(object):
+    """
+    Fallback poller for platforms without epoll. Costs O(n) per wakeup and is limited to ``FD_SETSIZE`` fds.
+    """
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events=READ):
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        if events & READ:
+            self.readers.add(fd)
+        else:
+            self.readers.discard(fd)
+        if events & WRITE:
+            self.writers.add(fd)
+        else:
+            self.writers.discard(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        everything = list(self.readers | self.writers)
+        try:
+            read_ready, write_ready, errors = select.select(list(self.readers), list(self.writers), everything, timeout)
+        except (OSError, IOError, select.error) as exc:
+            if interrupted(exc):
+                return []
+            raise
+        events = {}
+        for fd in read_ready:
+            events[fd] = events.get(fd, 0) | READ
+        for fd in write_ready:
+            events[fd] = events.get(fd, 0) | WRITE
+        for fd in errors:
+            events[fd] = events.get(fd, 0) | ERROR
+        return list(events.items())
+
+    def close(self):
+        self.readers.clear()
+        self.writers.clear()
+
+
+class EpollPoller(object):
+    """
+    Level-triggered epoll poller. Fds are registered once and the kernel keeps the interest list so each wakeup only
+    costs as much as the number of ready fds.
+    """
+    def __init__(self):
+        self.epoll = select.epoll()
+        cloexec(self.epoll.fileno())
+        self.fds = {}
+
+    def register(self, fd, events=READ):
+        fileno = fileno_of(fd)
+        self.epoll.register(fileno, events)
+        self.fds[fileno] = fd
+
+    def modify(self, fd, events):
+        self.epoll.modify(fileno_of(fd), events)
+
+    def unregister(self, fd):
+        fileno = fileno_of(fd)
+        del self.fds[fileno]
+        self.epoll.unregister(fileno)
+
+    def poll(self, timeout):
+        try:
+            ready = self.epoll.poll(timeout)
+        except (OSError, IOError) as exc:
+            if interrupted(exc):
+                return []
+            raise
+        return [(self.fds[fileno], events) for fileno, events in ready]
+
+    def close(self):
+        self.fds.clear()
+        self.epoll.close()
+
+
+DefaultPoller = EpollPoller if hasattr(select, "epoll") else SelectPoller
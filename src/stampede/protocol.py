@@ -0,0 +1,129 @@
+import json
+import signal
+
+# Protocol 1 is a single "key\n" request per connection answered with a JSON object (no line ending) after which the
+# connection is closed.
+#
+# Protocol 2 is negotiated by sending HANDSHAKE as the first line. The worker answers with a HELLO line and from then on
+# the connection is persistent: every line is a JSON request like {"id": 1, "key": "..."} and every response is a JSON
+# line like {"id": 1, "exit_code": 0, "pid": 123}. Responses are sent as tasks complete so they can arrive out of order.
+# Keys are arbitrary bytes so they are transmitted as latin-1 strings (a lossless byte to codepoint mapping).
+#
+# A protocol 2 request or response can carry a binary payload (task argument or task result): the JSON line has a
+# "size" field and exactly that many bytes follow it.
+#
+# A protocol 2 request with "shared": true asks for the result as a file descriptor: the response has a "shared" field
+# with the result's size instead of "size" and the fd is attached (SCM_RIGHTS) to the response's first byte.
+#
+# A protocol 2 request with "stale": true accepts the last result of the key (if there's one in the result cache, even
+# if it expired): the response has a "stale" field with the result's age (in seconds) and comes right away, while the
+# task runs again in the background.
+#
+# A protocol 2 {"id": 1, "op": "stats"} request is answered right away with {"id": 1, "stats": {...}} (the worker's
+# metrics snapshot).
+#
+# A protocol 2 {"id": 1, "op": "handoff"} request (only allowed from the worker's own user) makes the worker pass
+# everything to the client - a new worker taking over. It answers with a stream of {"op": ...} messages: "listener" (the
+# listening socket is attached), a "connection" for every client (the socket and any pending result fds are attached,
+# the buffered input and output follow the line), a "workspace" for every key (the payload follows, as a "size" frame),
+# a "result" for every cached result and then "end". After that a "completed" message is sent as every task that was
+# already running completes (the result follows as a "size" frame or is attached, like a shared response) and the
+# connection is closed after the last one.
+#
+# A task that runs out of time is stopped by the worker. Protocol 2 responses for it have "timeout": true and
+# TIMEOUT_EXIT_CODE as the exit code (no process can exit with it: exit codes are 0-255 and processes killed by a signal
+# get minus the signal number). Protocol 1 responses get LEGACY_TIMEOUT_EXIT_CODE, what older workers reported for tasks
+# killed by their SIGALRM (a task that kills itself with SIGALRM looks the same).
+#
+# Keys can't have line endings so the handshake can't collide with a protocol 1 request. It's all whitespace so older
+# workers, that only know protocol 1 and strip the line, take it for an empty (health check) request and close the
+# connection without running anything - clients can then fall back to protocol 1. LEGACY_HANDSHAKE is still accepted.
+HANDSHAKE = b"\r\t\x0b\t\x0c"
+LEGACY_HANDSHAKE = b"\rSTAMPEDE/2"
+VERSION = 2
+TIMEOUT_EXIT_CODE = 256
+LEGACY_TIMEOUT_EXIT_CODE = signal.SIGALRM
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_key(key):
+    return key.decode('latin-1')
+
+
+def decode_key(value):
+    return value.encode('latin-1')
+
+
+def encode_line(message):
+    return json.dumps(message, separators=(',', ':')).encode('ascii') + b"\n"
+
+
+def decode_line(line):
+    try:
+        message = json.loads(line.decode('ascii'))
+    except ValueError as exc:
+        raise ProtocolError("Invalid message %r: %s" % (line, exc))
+    if not isinstance(message, dict):
+        raise ProtocolError("Invalid message %r: not an object" % line)
+    return message
+
+
+def encode_hello():
+    return encode_line({"version": VERSION})
+
+
+def encode_frame(message, payload):
+    if payload is None:
+        return encode_line(message)
+    else:
+        message["size"] = len(payload)
+        return encode_line(message) + payload
+
+
+def encode_request(request_id, key, wait=True, payload=None, shared=False, stale=False):
+    message = {"id": request_id, "key": encode_key(key)}
+    if not wait:
+        message["wait"] = False
+    if shared:
+        message["shared"] = True
+    if stale:
+        message["stale"] = True
+    return encode_frame(message, payload)
+
+
+def encode_response(exit_code, pid, request_id=None, payload=None, stale=None):
+    if request_id is None:
+        if exit_code == TIMEOUT_EXIT_CODE:
+            exit_code = LEGACY_TIMEOUT_EXIT_CODE
+        return json.dumps({"exit_code": exit_code, "pid": pid}).encode('ascii')
+    else:
+        message = {"id": request_id, "exit_code": exit_code, "pid": pid}
+        if exit_code == TIMEOUT_EXIT_CODE:
+            message["timeout"] = True
+        if stale is not None:
+            message["stale"] = stale
+        return encode_frame(message, payload)
+
+
+def encode_stats_request(request_id):
+    return encode_line({"id": request_id, "op": "stats"})
+
+
+def encode_handoff_request(request_id):
+    return encode_line({"id": request_id, "op": "handoff"})
+
+
+def encode_stats(request_id, stats):
+    return encode_line({"id": request_id, "stats": stats})
+
+
+def encode_shared_response(request_id, exit_code, pid, size, stale=None):
+    message = {"id": request_id, "exit_code": exit_code, "pid": pid, "shared": size}
+    if exit_code == TIMEOUT_EXIT_CODE:
+        message["timeout"] = True
+    if stale is not None:
+        message["stale"] = stale
+    return encode_line(message)
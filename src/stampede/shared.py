@@ -0,0 +1,94 @@
+import fcntl
+import mmap
+import os
+import tempfile
+from contextlib import closing
+
+from .utils import cloexec
+from .utils import write_all
+
+MFD_CLOEXEC = getattr(os, "MFD_CLOEXEC", 0)
+MFD_ALLOW_SEALING = getattr(os, "MFD_ALLOW_SEALING", 0)
+SEALS = 0
+for name in "F_SEAL_SEAL", "F_SEAL_SHRINK", "F_SEAL_GROW", "F_SEAL_WRITE":
+    SEALS |= getattr(fcntl, name, 0)
+
+
+def create_memfd(name="stampede-result"):
+    """
+    Creates an anonymous file. Uses ``memfd_create`` if available, otherwise an unlinked temporary file.
+    """
+    if hasattr(os, "memfd_create"):
+        return os.memfd_create(name, MFD_CLOEXEC | MFD_ALLOW_SEALING)
+    with tempfile.TemporaryFile(prefix=name) as fh:
+        return cloexec(os.dup(fh.fileno()))
+
+
+def seal(fd):
+    """
+    Makes the memfd immutable (if the platform supports file seals) so clients can't change a result shared with others.
+    """
+    if SEALS and hasattr(fcntl, "F_ADD_SEALS"):
+        try:
+            fcntl.fcntl(fd, fcntl.F_ADD_SEALS, SEALS)
+        except (IOError, OSError):
+            # tmpfile fallback or a kernel without sealing
+            pass
+
+
+def to_shared(result):
+    return result if isinstance(result, SharedResult) else SharedResult.from_bytes(result)
+
+
+def to_bytes(result):
+    return result.read() if isinstance(result, SharedResult) else result
+
+
+class SharedResult(object):
+    """
+    A task result kept in an anonymous file. Clients that ask for it get the file descriptor (via ``SCM_RIGHTS``)
+    instead of a copy of the data. The file is closed when the last reference is gone.
+    """
+    def __init__(self, fd, size):
+        self.file = os.fdopen(fd, "rb")
+        self.size = size
+        self.data = None
+
+    @classmethod
+    def from_fd(cls, fd):
+        """
+        Wraps the memfd a task wrote its result into. Returns ``None`` (and closes the fd) if it's empty.
+        """
+        size = os.fstat(fd).st_size
+        if not size:
+            os.close(fd)
+            return None
+        seal(fd)
+        return cls(fd, size)
+
+    @classmethod
+    def from_bytes(cls, data):
+        fd = create_memfd()
+        try:
+            write_all(fd, data)
+        except Exception:
+            os.close(fd)
+            raise
+        return cls.from_fd(fd)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self):
+        if self.data is None:
+            with closing(mmap.mmap(self.fileno(), self.size, prot=mmap.PROT_READ)) as buf:
+                self.data = buf[:]
+        return self.data
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return "SharedResult(fd=%s, size=%s)" % (self.fileno(), self.size)
+
+    __repr__ = __str__
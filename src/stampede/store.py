@@ -0,0 +1,265 @@
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+from logging import getLogger
+from time import time
+
+from .cache import Result
+from .shared import to_bytes
+from .utils import cloexec
+from .utils import close
+from .utils import write_all
+
+logger = getLogger(__name__)
+
+# A log record is the header, the key and the payload. The checksum covers everything after it so a record torn by a
+# crash is detected (and dropped) when the log is opened again.
+RECORD = struct.Struct("<IIIiid")  # checksum, key size, payload size, exit code, pid, finished
+NO_PAYLOAD = 0xffffffff
+# The index is a header and an open addressing (linear probing) table of slots. It records the log it was built for
+# (inode and size) and it's rebuilt from the log if that doesn't match, eg: after a crash between the log append and
+# the index update.
+INDEX_HEADER = struct.Struct("<8sQQQQQ")  # magic, capacity, count, log inode, log size, dead size
+INDEX_MAGIC = b"STAMPIX1"
+SLOT = struct.Struct("<QQ")  # key hash, record offset + 1 (0 means empty)
+
+
+def hash_key(key):
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+
+def encode_record(key, result):
+    payload = to_bytes(result.payload)
+    header = RECORD.pack(0, len(key), NO_PAYLOAD if payload is None else len(payload),
+                         result.exit_code, result.pid, result.finished)[4:]
+    data = header + key + (payload or b"")
+    return struct.pack("<I", zlib.crc32(data) & 0xffffffff) + data
+
+
+class ResultStore(object):
+    """
+    Task results kept on disk so they survive restarts: an append-only log (``<path>.log``) and a hash index of the
+    latest record of every key (``<path>.idx``, mapped in memory). A lookup costs a probe in the index and a read from
+    the log. The latest record of a key is kept even if it expired (it can still be served as a stale result, the
+    cache decides that) so only overwritten records are dropped when the log is compacted (see :meth:`should_compact`).
+    Only one process can use the files at a time.
+    """
+    initial_capacity = 1024
+    compact_min_size = 1024 * 1024  # don't bother compacting smaller logs
+
+    def __init__(self, path):
+        self.log_path = "%s.log" % path
+        self.index_path = "%s.idx" % path
+        self.log_fd = cloexec(os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600))
+        self.log_size = os.fstat(self.log_fd).st_size
+        self.index_fd = self.index = None
+        if not self.load_index():
+            self.rebuild_index()
+
+    def read_at(self, offset, size):
+        os.lseek(self.log_fd, offset, os.SEEK_SET)
+        chunks = []
+        while size:
+            chunk = os.read(self.log_fd, size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def read_record(self, offset):
+        """
+        Returns the ``(key, result, size)`` of the record at ``offset`` or ``None`` if it's incomplete or corrupted.
+        """
+        header = self.read_at(offset, RECORD.size)
+        if len(header) < RECORD.size:
+            return None
+        checksum, key_size, payload_size, exit_code, pid, finished = RECORD.unpack(header)
+        size = key_size + (0 if payload_size == NO_PAYLOAD else payload_size)
+        data = self.read_at(offset + RECORD.size, size)
+        if len(data) < size or zlib.crc32(header[4:] + data) & 0xffffffff != checksum:
+            return None
+        payload = None if payload_size == NO_PAYLOAD else data[key_size:]
+        return data[:key_size], Result(exit_code, pid, finished, payload), RECORD.size + size
+
+    def create_index(self, capacity):
+        path = "%s-pending" % self.index_path
+        fd = cloexec(os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600))
+        try:
+            os.ftruncate(fd, INDEX_HEADER.size + capacity * SLOT.size)
+            index = mmap.mmap(fd, INDEX_HEADER.size + capacity * SLOT.size)
+        except Exception:
+            os.close(fd)
+            raise
+        return path, fd, index
+
+    def replace_index(self, path, fd, index, capacity):
+        self.close_index()
+        self.index_fd, self.index, self.capacity = fd, index, capacity
+        self.write_header()
+        os.rename(path, self.index_path)
+
+    def load_index(self):
+        try:
+            fd = cloexec(os.open(self.index_path, os.O_RDWR))
+        except OSError:
+            return False
+        size = os.fstat(fd).st_size
+        if size < INDEX_HEADER.size:
+            os.close(fd)
+            return False
+        index = mmap.mmap(fd, size)
+        magic, capacity, count, log_inode, log_size, dead_size = INDEX_HEADER.unpack_from(index)
+        if (magic != INDEX_MAGIC or size != INDEX_HEADER.size + capacity * SLOT.size or
+                log_inode != os.fstat(self.log_fd).st_ino or log_size != self.log_size):
+            logger.warning("Index %r doesn't match the log, rebuilding it", self.index_path)
+            index.close()
+            os.close(fd)
+            return False
+        self.index_fd, self.index = fd, index
+        self.capacity, self.count, self.dead_size = capacity, count, dead_size
+        return True
+
+    def rebuild_index(self):
+        self.count = self.dead_size = 0
+        self.replace_index(*self.create_index(self.initial_capacity) + (self.initial_capacity,))
+        offset = 0
+        while offset < self.log_size:
+            record = self.read_record(offset)
+            if record is None:
+                logger.warning("Dropping the incomplete end of %r (%s bytes)", self.log_path, self.log_size - offset)
+                os.ftruncate(self.log_fd, offset)
+                self.log_size = offset
+                break
+            key, _, size = record
+            self.insert(key, offset)
+            offset += size
+        self.write_header()
+
+    def write_header(self):
+        INDEX_HEADER.pack_into(self.index, 0, INDEX_MAGIC, self.capacity, self.count, os.fstat(self.log_fd).st_ino,
+                               self.log_size, self.dead_size)
+
+    def lookup(self, key, key_hash):
+        """
+        Returns the slot of ``key`` (or the empty slot where it should go) and its record (or ``None``).
+        """
+        mask = self.capacity - 1
+        slot = key_hash & mask
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.index, INDEX_HEADER.size + slot * SLOT.size)
+            if not offset:
+                return slot, None
+            if slot_hash == key_hash:
+                record = self.read_record(offset - 1)
+                if record is not None and record[0] == key:
+                    return slot, record
+            slot = (slot + 1) & mask
+
+    def insert(self, key, offset):
+        key_hash = hash_key(key)
+        slot, record = self.lookup(key, key_hash)
+        if record is None:
+            self.count += 1
+        else:
+            self.dead_size += record[2]
+        SLOT.pack_into(self.index, INDEX_HEADER.size + slot * SLOT.size, key_hash, offset + 1)
+        if self.count * 2 > self.capacity:
+            self.resize(self.capacity * 2)
+
+    def resize(self, capacity):
+        path, fd, index = self.create_index(capacity)
+        mask = capacity - 1
+        for key_hash, offset in self.iter_slots():
+            slot = key_hash & mask
+            while SLOT.unpack_from(index, INDEX_HEADER.size + slot * SLOT.size)[1]:
+                slot = (slot + 1) & mask
+            SLOT.pack_into(index, INDEX_HEADER.size + slot * SLOT.size, key_hash, offset + 1)
+        self.replace_index(path, fd, index, capacity)
+
+    def iter_slots(self):
+        for slot in range(self.capacity):
+            key_hash, offset = SLOT.unpack_from(self.index, INDEX_HEADER.size + slot * SLOT.size)
+            if offset:
+                yield key_hash, offset - 1
+
+    def get(self, key):
+        _, record = self.lookup(key, hash_key(key))
+        if record is not None:
+            return record[1]
+
+    def set(self, key, result):
+        record = encode_record(key, result)
+        offset = self.log_size
+        write_all(self.log_fd, record)
+        self.log_size += len(record)
+        self.insert(key, offset)
+        self.write_header()
+
+    def should_compact(self, idle=False):
+        """
+        Compacting blocks the worker loop for a while so it's left to the loop: when it's idle the log is compacted
+        once half of it is overwritten records, when it's busy only once most of it is.
+        """
+        if self.dead_size < self.compact_min_size:
+            return False
+        elif idle:
+            return self.dead_size * 2 >= self.log_size
+        else:
+            return self.dead_size * 4 >= self.log_size * 3
+
+    def compact(self):
+        """
+        Rewrites the log without the overwritten records.
+        """
+        started = time()
+        before = self.log_size
+        path = "%s-pending" % self.log_path
+        fd = cloexec(os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600))
+        live = []
+        try:
+            size = 0
+            for _, offset in self.iter_slots():
+                record = self.read_record(offset)
+                if record is not None:
+                    data = encode_record(record[0], record[1])
+                    write_all(fd, data)
+                    live.append((record[0], size))
+                    size += len(data)
+            os.fsync(fd)
+            os.rename(path, self.log_path)
+        except Exception:
+            os.close(fd)
+            raise
+        os.close(self.log_fd)
+        self.log_fd, self.log_size = fd, size
+        self.count = self.dead_size = 0
+        capacity = self.initial_capacity
+        while len(live) * 2 > capacity:
+            capacity *= 2
+        self.replace_index(*self.create_index(capacity) + (capacity,))
+        for key, offset in live:
+            self.insert(key, offset)
+        self.write_header()
+        logger.info("Compacted %r from %s to %s bytes (%s results) in %.3fs", self.log_path, before, size, len(live),
+                    time() - started)
+
+    def close_index(self):
+        if self.index is not None:
+            self.index.close()
+            os.close(self.index_fd)
+            self.index_fd = self.index = None
+
+    def close(self):
+        self.close_index()
+        close(self.log_fd)
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        return "ResultStore(%r, %s entries, %s bytes)" % (self.log_path, self.count, self.log_size)
+
+    __repr__ = __str__
@@ -2,16 +2,25 @@ import errno
 import fcntl
 import os
 import signal
+import socket
 import sys
 from collections import namedtuple
 from logging import getLogger
 
 import signalfd
 
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover
+    # Python 2 - deadlines follow the wall clock there
+    from time import time as monotonic  # noqa
+
 logger = getLogger(__name__)
 
 ProcessExit = namedtuple("ProcessExit", ["pid", "status"])
 IS_PY2 = sys.version_info[0] == 2
+READY_FD_ENV = "STAMPEDE_READY_FD"
+SD_LISTEN_FDS_START = 3
 
 
 def close(*fds):
@@ -34,6 +43,78 @@ def cloexec(fd):
     return fd
 
 
+def get_exit_code(exc):
+    """
+    Returns the process exit code for a ``SystemExit``, like the interpreter does.
+    """
+    if exc.code is None:
+        return 0
+    elif isinstance(exc.code, int):
+        return exc.code & 0xff
+    else:
+        return 1
+
+
+def get_listen_fds():
+    """
+    Returns the file descriptors passed with systemd-style socket activation (``LISTEN_FDS`` and ``LISTEN_PID``). The
+    variables are removed from the environment so they don't leak into tasks.
+    """
+    count = os.environ.pop("LISTEN_FDS", "")
+    pid = os.environ.pop("LISTEN_PID", "")
+    os.environ.pop("LISTEN_FDNAMES", None)
+    if not count.isdigit() or pid != str(os.getpid()):
+        return []
+    return list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + int(count)))
+
+
+def get_somaxconn():
+    """
+    Returns the maximum listen backlog allowed by the system.
+    """
+    try:
+        with open("/proc/sys/net/core/somaxconn") as fh:
+            return int(fh.read())
+    except (IOError, OSError, ValueError):
+        if IS_PY2:
+            sys.exc_clear()
+        return socket.SOMAXCONN
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except OSError as exc:
+            if exc.errno != errno.EINTR:
+                raise
+            if IS_PY2:
+                sys.exc_clear()
+
+
+def read_signals(sigfd):
+    """
+    Drains a signalfd. Returns the number of signals that were read.
+    """
+    count = 0
+    while True:
+        try:
+            signalfd.read_siginfo(sigfd)
+        except (OSError, IOError) as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+            if IS_PY2:
+                sys.exc_clear()
+            return count
+        count += 1
+
+
+def set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return fd
+
+
 def collect_sigchld(sigfd, closeok=False):
     pending = {}
 
@@ -1,34 +1,109 @@
-﻿import json
+﻿import array
+import errno
+import gc
+import heapq
+import itertools
 import os
-import pwd
-import select
 import signal
 import socket
 import struct
+import zlib
+from collections import deque
 from contextlib import closing
 from logging import getLogger
+from time import time
 
 import signalfd
 
+from .cache import ResultCache
+from .client import ClientConnection
+from .connection import ClientId
+from .connection import Connection
+from .connection import would_block
+from .executors import ForkExecutor
 from .lock import FileLock
+from .lock import SpawnLock
+from .metrics import Metrics
+from .poller import ERROR
+from .poller import EXCLUSIVE
+from .poller import READ
+from .poller import WRITE
+from .poller import DefaultPoller
+from .protocol import HANDSHAKE
+from .protocol import LEGACY_HANDSHAKE
+from .protocol import TIMEOUT_EXIT_CODE
+from .protocol import VERSION
+from .protocol import ProtocolError
+from .protocol import decode_key
+from .protocol import decode_line
+from .protocol import encode_frame
+from .protocol import encode_handoff_request
+from .protocol import encode_hello
+from .protocol import encode_key
+from .protocol import encode_line
+from .protocol import encode_request
+from .protocol import encode_response
+from .protocol import encode_shared_response
+from .protocol import encode_stats
+from .shared import SharedResult
+from .shared import to_bytes
+from .shared import to_shared
+from .store import ResultStore
+from .utils import IS_PY2
+from .utils import READY_FD_ENV
 from .utils import cloexec
 from .utils import close
-from .utils import collect_sigchld
+from .utils import get_exit_code
+from .utils import get_listen_fds
+from .utils import get_somaxconn
+from .utils import monotonic
+from .utils import read_signals
+from .utils import write_all
 
 logger = getLogger(__name__)
 
 SO_PEERCRED = 17
+SO_ACCEPTCONN = 30
+
+
+class ClientList(object):
+    """
+    Lazily formatted list of client ids (so there's no formatting cost unless the message is logged).
+    """
+    def __init__(self, clients):
+        self.clients = clients
+
+    def __str__(self):
+        return ", ".join(str(conn.client_id) for conn, _ in self.clients)
 
 
 class Workspace(object):
-    def __init__(self, key):
+    def __init__(self, key, payload=None):
         self.key = key
+        self.payload = payload
         self.clients = []
         self.started = False
+        self.started_at = None
+        self.queued = False
+        self.held = False
+        self.held_until = None
+        self.arrivals = None  # when the requests that found it held arrived
 
     @property
     def formatted_clients(self):
-        return ", ".join(i for _, _, i in self.clients)
+        return ClientList(self.clients)
+
+    def count_runs(self, duration):
+        """
+        Returns how many times the task would have run (each run taking ``duration``) if it wasn't held.
+        """
+        runs = 0
+        end = None
+        for arrival in self.arrivals:
+            if end is None or arrival > end:
+                runs += 1
+                end = arrival + duration
+        return runs
 
     def __str__(self):
         return "Workspace(%s, clients=[%s])" % (
@@ -39,6 +114,108 @@ class Workspace(object):
     __repr__ = __str__
 
 
+class HandoffConnection(ClientConnection):
+    """
+    Connection to the worker that is being taken over. Lots of fds can come in a single message.
+    """
+    max_fds = 253  # SCM_MAX_FD
+
+    def read_fd(self):
+        if not self.fds:
+            raise ProtocolError("Missing file descriptor")
+        return self.fds.popleft()
+
+    def read_socket(self):
+        fd = self.read_fd()
+        try:
+            return cloexec(socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM))
+        finally:
+            os.close(fd)
+
+    def read_file(self):
+        fd = self.read_fd()
+        return SharedResult(fd, os.fstat(fd).st_size)
+
+    def read_available(self):
+        """
+        Yields the messages that were completely received (the payload is in the "payload" field) without blocking.
+        """
+        while True:
+            pos = self.rbuf.find(b"\n")
+            if pos == -1:
+                return
+            message = decode_line(bytes(self.rbuf[:pos + 1]))
+            if len(self.rbuf) < pos + 1 + message.get("size", 0):
+                return
+            del self.rbuf[:pos + 1]
+            if "size" in message:
+                message["payload"] = self.read_exactly(message["size"])
+            yield message
+
+
+class PeerConnection(Connection):
+    """
+    Connection to another shard, used for forwarding the tasks it owns. Results come back as file descriptors.
+    """
+    max_fds = 16
+
+    def __init__(self, sock, shard):
+        super(PeerConnection, self).__init__(sock, "shard-%s" % shard)
+        self.shard = shard
+        self.fds = deque()
+        self.counter = itertools.count(1)
+        self.requests = {}
+
+    def fill(self):
+        try:
+            if hasattr(self.sock, "recvmsg"):
+                data, ancillary, _, _ = self.sock.recvmsg(self.read_size, socket.CMSG_SPACE(self.max_fds * 4),
+                                                          getattr(socket, "MSG_CMSG_CLOEXEC", 0))
+                for level, kind, fds in ancillary:
+                    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                        received = array.array("i")
+                        received.frombytes(fds[:len(fds) - len(fds) % received.itemsize])
+                        self.fds.extend(received)
+            else:
+                data = self.sock.recv(self.read_size)
+        except socket.error as exc:
+            if would_block(exc):
+                return
+            raise
+        if data:
+            self.rbuf.extend(data)
+        else:
+            self.eof = True
+
+    def read_responses(self):
+        """
+        Yields ``(message, result)`` for every response that was completely received.
+        """
+        while True:
+            if self.message is None:
+                line = self.readline()
+                if line is None:
+                    return
+                self.message = decode_line(line)
+            if "size" in self.message:
+                result = self.read_exactly(self.message["size"])
+                if result is None:
+                    return
+            elif "shared" in self.message:
+                if not self.fds:
+                    raise ProtocolError("Missing file descriptor for shared result")
+                result = SharedResult(self.fds.popleft(), self.message["shared"])
+            else:
+                result = None
+            message, self.message = self.message, None
+            yield message, result
+
+    def close(self):
+        super(PeerConnection, self).close()
+        close(*self.fds)
+        self.fds.clear()
+
+
 class SingleInstanceMeta(type):
     __inst = None
 
@@ -49,6 +226,13 @@ class SingleInstanceMeta(type):
         lock = FileLock(path)
         if lock.acquire():
             inst = cls.__inst = super(SingleInstanceMeta, cls).__call__(path, *args, **kwargs)
+            inst.instance_lock = lock
+            return inst
+        # handoff might be passed positionally or by a subclass, the instance has the value __init__ got
+        inst = super(SingleInstanceMeta, cls).__call__(path, *args, **kwargs)
+        if getattr(inst, "handoff", False):
+            # the running instance passes everything over and exits - the lock is taken after that
+            cls.__inst = inst
             return inst
         else:
             return StampedeStub()
@@ -63,125 +247,1122 @@ class StampedeWorker(SingleInstanceMeta("StampedeWorkerBase", (object,), {})):
     queues = {}
     clients = {}
     tasks = {}
-    alarm_time = 5 * 60  # abort in 5 minutes if no progress
-    socket_backlog = 5
+    pending = []
+    pending_counter = itertools.count()
+    unflushed = set()
+    unflushed_peers = set()
+    deadlines = deque()
+    task_deadlines = []  # heap of (deadline, tiebreaker, task_id, workspace)
+    held = []  # heap of (start time, tiebreaker, workspace)
+    alarm_time = 5 * 60  # kill tasks that run longer than 5 minutes (the default for get_timeout)
+    coalesce_delay = None  # seconds to wait for more clients before starting a task (the default for get_delay)
+    socket_backlog = None  # None means the system's maximum (net.core.somaxconn)
+    poller_class = DefaultPoller
+    request_timeout = 1  # fail fast on clients that don't send their request
+    max_tasks = None  # maximum number of concurrently running tasks (None means unlimited)
+    result_ttl = None  # seconds to reuse a finished task's result for new requests (None disables the cache)
+    result_cache_size = 1000
+    result_store_path = None  # also keep the cached results in files at this path so restarts start warm
+    executor_class = ForkExecutor
+    max_payload_size = 16 * 1024 * 1024
+    shared_results = False  # forked tasks write results straight into a memfd that can be passed to clients
+    metrics_socket_path = None  # serve metrics in the Prometheus text format (over HTTP) on this unix socket
+    state_signal = signal.SIGUSR1  # log the queues when receiving this signal
+    state_log_interval = None  # also log the queues periodically (at most every that many seconds)
+    freeze_gc = True  # after preload() move all objects to the permanent generation (so tasks don't dirty shared pages)
+    handoff_timeout = 10  # seconds allowed for passing the clients and queues to a new worker
+    shards = None  # run that many event loops (processes) with every key owned by one of them (None means a single loop)
+    shard_accepts = 8  # connections a shard accepts per wakeup (the rest are left to the other shards)
+    next_state_log = 0
+    instance_lock = None
+    successor = None  # connection to the worker that took over
+    predecessor = None  # connection to the worker that was taken over
+    shard = None
+    peers = ()  # connections for forwarding to the other shards (by shard index)
+    peer_clients = ()  # connections from the other shards (before the loop starts)
+    supervisor_fd = None  # in shards: gets EOF when the supervisor (that holds the instance lock) exits
 
-    def __init__(self, path):
+    def __init__(self, path, listen_fd=None, handoff=False):
+        if handoff and self.shards:
+            raise RuntimeError("Sharded workers can't be taken over!")
+        self.path = path
         self.socket_path = "%s.sock" % path
+        self.listen_fd = listen_fd
+        self.handoff = handoff
+        self.inherited = []
+        self.handlers = {}
+        self.results = ResultCache(self.result_ttl, self.result_cache_size) if self.result_ttl else None
+        self.metrics = Metrics(self.get_gauges)
+        self.metrics_sock = None
 
     def notify_progress(self, *_a, **_kw):
-        signal.alarm(self.alarm_time)
+        """
+        Does nothing. Tasks used to call this to postpone their ``SIGALRM``, now they have a fixed time budget (see
+        :meth:`get_timeout`) enforced by the worker loop.
+        """
+
+    def preload(self):
+        """
+        Override this to import modules, load models and whatever else tasks need. It runs once, in the daemon, before
+        the socket is bound. Forked tasks start with all of it already in memory (shared copy-on-write with the daemon)
+        instead of loading it again in every task.
+        """
+
+    def warm_up(self):
+        t = time()
+        self.preload()
+        if self.freeze_gc and hasattr(gc, "freeze"):
+            # the collector writes in the header of every object it visits so a collection in a task would copy all the
+            # pages it touched - frozen objects are never visited
+            gc.collect()
+            gc.freeze()
+        logger.info("Preloaded in %.3fs", time() - t)
+
+    def create_executor(self):
+        return self.executor_class(self)
+
+    def get_priority(self, key):
+        """
+        Override this to schedule some keys ahead of others when ``max_tasks`` is reached. Lower values run first, keys
+        with the same priority run in the order they were requested.
+        """
+        return 0
+
+    def get_timeout(self, key):
+        """
+        Override this to give some keys more (or less) time. Returns the seconds a task may run before it's killed and
+        its clients get ``TIMEOUT_EXIT_CODE``, ``None`` means no limit.
+        """
+        return self.alarm_time
+
+    def get_delay(self, key):
+        """
+        Override this to hold the tasks of some keys (eg: by prefix) before starting them so requests that arrive
+        meanwhile are collapsed into the same run. Returns the seconds to wait, ``None`` or ``0`` start it right away.
+        """
+        return self.coalesce_delay
+
+    def get_shard(self, key):
+        """
+        Returns the index of the shard that owns ``key``. Override this to route keys differently, it must always return
+        the same shard for a key.
+        """
+        return (zlib.crc32(key) & 0xffffffff) % self.shards
+
+    def get_gauges(self):
+        gauges = {
+            "workspaces": len(self.queues),
+            "running_tasks": self.running_count,
+            "pending_tasks": self.pending_count,
+            "held_workspaces": len(self.held),
+            "connections": len(self.clients),
+            "cached_results": 0 if self.results is None else len(self.results),
+        }
+        if self.shards:
+            gauges["shard"] = self.shard
+        return gauges
+
+    @property
+    def running_count(self):
+        # tasks that timed out but didn't stop yet (eg: pool calls can't be stopped) still take a place
+        return len(self.tasks) + len(self.executor.cancelled)
+
+    @property
+    def pending_count(self):
+        return len(self.pending)
 
     def process_workspace(self, workspace):
+        if not workspace.started and not workspace.queued and not workspace.held:
+            shard = self.get_shard(workspace.key) if self.shards else None
+            if shard != self.shard:
+                self.forward_task(workspace, self.peers[shard])
+            elif workspace.held_until is None and self.get_delay(workspace.key):
+                self.hold_workspace(workspace)
+            elif self.max_tasks is None or self.running_count < self.max_tasks:
+                self.start_task(workspace)
+            else:
+                workspace.queued = True
+                heapq.heappush(self.pending, (self.get_priority(workspace.key), next(self.pending_counter), workspace))
+                logger.info("Queued %s (%s pending)", workspace, self.pending_count)
+
+    def hold_workspace(self, workspace):
+        now = monotonic()
+        workspace.held = True
+        workspace.held_until = now + self.get_delay(workspace.key)
+        workspace.arrivals = [now]
+        heapq.heappush(self.held, (workspace.held_until, next(self.pending_counter), workspace))
+        self.metrics.incr("held_tasks")
+        logger.debug("Holding %s for %.3fs", workspace, workspace.held_until - now)
+
+    def process_pending(self):
+        while self.pending and (self.max_tasks is None or self.running_count < self.max_tasks):
+            _, _, workspace = heapq.heappop(self.pending)
+            workspace.queued = False
+            self.start_task(workspace)
+
+    def start_task(self, workspace):
         if not workspace.started:
             workspace.started = True
-            pid = os.fork()
-            if pid:
-                self.tasks[pid] = workspace
-                logger.info("Started task %r for %s", pid, workspace)
+            workspace.started_at = monotonic()
+            try:
+                task_id = self.executor.submit(workspace.key, workspace.payload)
+            except Exception:
+                # eg: fork failed with EAGAIN/ENOMEM or the pool is broken - don't leave the clients waiting forever
+                logger.exception("Failed to start task for %s", workspace)
+                workspace.started = False
+                workspace.started_at = None
+                self.metrics.incr("tasks_not_started")
+                self.queues.pop(workspace.key)
+                self.pass_back(workspace, 255, os.getpid(), None)
+                return
+            self.metrics.observe("submit_seconds", monotonic() - workspace.started_at)
+            self.metrics.incr("tasks_started")
+            self.tasks[task_id] = workspace
+            logger.info("Started task %r for %s", task_id, workspace)
+            if not self.executor.reports_start:
+                self.task_started(task_id, workspace.started_at)
+
+    def task_started(self, task_id, started_at):
+        """
+        Starts the task's deadline. Executors that can queue tasks (``reports_start``) call this when the task actually
+        starts running.
+        """
+        workspace = self.tasks.get(task_id)
+        if workspace is not None:
+            timeout = self.get_timeout(workspace.key)
+            if timeout is not None:
+                self.add_task_deadline(started_at + timeout, task_id, workspace)
+
+    def add_task_deadline(self, deadline, task_id, workspace):
+        if len(self.task_deadlines) > 2 * self.running_count + 64:
+            # entries of completed tasks are only dropped when they expire, don't let them pile up
+            self.task_deadlines[:] = [item for item in self.task_deadlines if self.tasks.get(item[2]) is item[3]]
+            heapq.heapify(self.task_deadlines)
+        heapq.heappush(self.task_deadlines, (deadline, next(self.pending_counter), task_id, workspace))
+
+    def execute_task(self, key, payload=None):
+        """
+        Runs ``handle_task`` and returns a ``(exit_code, result)`` tuple. If ``handle_task`` returns bytes they are
+        passed back to the clients as the result.
+        """
+        exit_code = 255
+        result = None
+        try:
+            if payload is None:
+                result = self.handle_task(key)
             else:
-                logger.info("Running task %r key=%s", os.getpid(), workspace.key)
-                exit_code = 255
-                try:
-                    try:
-                        self.notify_progress()
-                        self.handle_task(workspace.key)
-                        logger.info("Completed task %r key=%s", os.getpid(), workspace.key)
-                    except Exception:
-                        logger.exception("Failed task %r key=%s", os.getpid(), workspace.key)
-                    except SystemExit as exc:
-                        exit_code = exc.code
-                        logger.exception("Failed task %r key=%s", os.getpid(), workspace.key)
-                    else:
-                        exit_code = 0
-                finally:
-                    os._exit(exit_code)
+                result = self.handle_task(key, payload)
+            logger.info("Completed task %r key=%s", os.getpid(), key)
+        except Exception:
+            logger.exception("Failed task %r key=%s", os.getpid(), key)
+        except SystemExit as exc:
+            exit_code = get_exit_code(exc)
+            logger.exception("Failed task %r key=%s", os.getpid(), key)
+        else:
+            exit_code = 0
+        return exit_code, result if isinstance(result, bytes) else None
 
-    def handle_task(self, key):
+    def handle_task(self, key, payload=None):
+        """
+        Override this. The ``payload`` argument is only passed if the request had one (the payload of the first
+        request is used when requests are collapsed).
+        """
         raise NotImplementedError()
 
-    def handle_signal(self, child_signals):
-        for pid, exit_code in collect_sigchld(child_signals).items():
-            if pid not in self.tasks:
-                logger.warn("Got SIGCHLD for unknown pid: %s", pid)
+    def handle_completions(self):
+        for task_id, exit_code, pid, result in self.executor.collect():
+            if task_id not in self.tasks:
+                logger.warn("Got completion for unknown task: %s", task_id)
                 continue
-            workspace = self.tasks.pop(pid)
-            self.queues.pop(workspace.key)
-            logger.info("Task %r completed. Passing back results to [%s]", pid, workspace.formatted_clients)
-            while workspace.clients:
-                fd, conn, client_id = workspace.clients.pop()
-                try:
-                    with closing(fd):
-                        with closing(conn):
-                            conn.write(json.dumps({"exit_code": exit_code, "pid": pid}).encode('ascii'))
-                        fd.shutdown(socket.SHUT_RDWR)
-                except Exception as exc:
-                    logger.error("Failed to send response to %s: %s", client_id, exc)
-
-    def handle_request(self, fd):
-        conn, client_id = self.clients.pop(fd)
+            self.finish_task(task_id, exit_code, pid, result)
+        self.flush_responses()
+        self.process_pending()
+
+    def finish_task(self, task_id, exit_code, pid, result=None):
+        finished = monotonic()
+        workspace = self.tasks.pop(task_id)
+        self.queues.pop(workspace.key)
+        self.metrics.incr("tasks_completed")
+        if exit_code:
+            self.metrics.incr("tasks_failed")
+        self.metrics.observe("task_seconds", finished - workspace.started_at)
+        self.metrics.observe("task_clients", len(workspace.clients))
+        if workspace.arrivals:
+            self.metrics.incr("saved_runs", workspace.count_runs(finished - workspace.started_at) - 1)
+        logger.info("Task %r completed. Passing back results to [%s]", task_id, workspace.formatted_clients)
+        if isinstance(result, bytes) and any(request_id in conn.shared for conn, request_id in workspace.clients):
+            # copy it once, all the clients get the same file
+            result = SharedResult.from_bytes(result)
+        if self.results is not None and exit_code != TIMEOUT_EXIT_CODE:
+            # a run that timed out says nothing about the next one
+            self.results.set(workspace.key, exit_code, pid, result)
+        self.pass_back(workspace, exit_code, pid, result)
+        if self.successor is not None:
+            self.forward_result(task_id, exit_code, pid, result)
+        self.metrics.observe("fanout_seconds", monotonic() - finished)
+
+    def pass_back(self, workspace, exit_code, pid, result):
+        while workspace.clients:
+            conn, request_id = workspace.clients.pop()
+            self.send_response(conn, request_id, exit_code, pid, result)
+
+    def send_response(self, conn, request_id, exit_code, pid, result=None, stale=None):
+        if conn.closed:
+            logger.debug("Not sending response to %s: connection already closed", conn.client_id)
+            return
+        self.metrics.incr("responses")
+        if request_id in conn.shared:
+            conn.shared.discard(request_id)
+            if result is not None:
+                result = to_shared(result)
+                conn.write(encode_shared_response(request_id, exit_code, pid, result.size, stale), [result])
+            else:
+                conn.write(encode_response(exit_code, pid, request_id, stale=stale))
+        else:
+            conn.write(encode_response(exit_code, pid, request_id, to_bytes(result), stale))
+        if request_id is None:
+            conn.closing = True
+        else:
+            conn.inflight -= 1
+            if not conn.reading and not conn.inflight:
+                conn.closing = True
+        self.unflushed.add(conn)
+
+    def flush_responses(self):
+        # responses are buffered so that a connection gets all its pending responses in a single send
+        while self.unflushed:
+            conn = self.unflushed.pop()
+            if not conn.closed:
+                self.handle_write(conn)
+        while self.unflushed_peers:
+            self.flush_peer(self.unflushed_peers.pop())
+
+    def update_events(self, conn):
+        events = (READ if conn.reading else 0) | (WRITE if conn.wbuf else 0)
+        if events != conn.events:
+            if not conn.events:
+                self.poller.register(conn.sock, events)
+                self.clients[conn.sock] = conn
+            elif not events:
+                self.poller.unregister(conn.sock)
+                del self.clients[conn.sock]
+            else:
+                self.poller.modify(conn.sock, events)
+            conn.events = events
+
+    def close_connection(self, conn):
+        conn.reading = False
+        del conn.wbuf[:]
+        self.update_events(conn)
+        if conn.sock in self.handlers:
+            # eg: a metrics connection that's still reading its request
+            self.remove_reader(conn.sock)
+        conn.close()
+
+    def handle_write(self, conn):
         try:
-            key = conn.readline().strip()
-            if not key:
-                # this is meant to support basic connect health checks
-                # (avoid having log garbage for healthcheck requests)
-                logger.info("Got empty request from client %s", client_id)
-                close(conn, fd)
-                return
-            if key in self.queues:
-                workspace = self.queues[key]
+            flushed = conn.flush()
+        except Exception as exc:
+            if conn.eof and not conn.closing:
+                # client sent its last request and left without waiting for any response
+                logger.debug("Failed to send to %s: %s", conn.client_id, exc)
             else:
-                workspace = self.queues.setdefault(key, Workspace(key))
-            workspace.clients.append((fd, conn, client_id))
+                logger.error("Failed to send response to %s: %s", conn.client_id, exc)
+            self.close_connection(conn)
+        else:
+            if flushed and conn.closing:
+                self.close_connection(conn)
+            else:
+                self.update_events(conn)
+
+    def handle_request(self, conn):
+        try:
+            conn.fill()
+            if conn.version == 1:
+                line = conn.readline()
+                if line is None:
+                    if conn.eof:
+                        logger.info("Got empty request from client %s", conn.client_id)
+                        self.close_connection(conn)
+                    return
+                if line != HANDSHAKE and line != LEGACY_HANDSHAKE:
+                    conn.reading = False
+                    conn.deadline = None
+                    self.update_events(conn)
+                    self.handle_key(conn, line.strip(), None, True)
+                    self.flush_responses()
+                    return
+                conn.version = 2
+                conn.deadline = None
+                conn.write(encode_hello())
+            while True:
+                if conn.message is None:
+                    line = conn.readline()
+                    if line is None:
+                        break
+                    message = decode_line(line)
+                    if message.get("op") == "stats":
+                        conn.write(encode_stats(message["id"], self.metrics.snapshot()))
+                        continue
+                    if message.get("op") == "handoff":
+                        self.send_handoff(conn)
+                        return
+                    key = decode_key(message["key"])
+                    if not key:
+                        raise ProtocolError("Empty key")
+                    if message.get("size", 0) > self.max_payload_size:
+                        raise ProtocolError("Payload exceeds %s bytes" % self.max_payload_size)
+                    conn.message = message, key
+                message, key = conn.message
+                if "size" in message:
+                    payload = conn.read_exactly(message["size"])
+                    if payload is None:
+                        break
+                else:
+                    payload = None
+                conn.message = None
+                conn.inflight += 1
+                if message.get("shared") and message.get("wait", True):
+                    conn.shared.add(message["id"])
+                self.handle_key(conn, key, message["id"], message.get("wait", True), payload, message.get("stale"))
+        except Exception:
+            logger.exception("Failed to read request from client %s", conn.client_id)
+            self.close_connection(conn)
+            return
+        if conn.eof:
+            conn.reading = False
+            if not conn.inflight:
+                conn.closing = True
+        self.unflushed.add(conn)
+        self.flush_responses()
+
+    def handle_key(self, conn, key, request_id, wait, payload=None, stale=False):
+        if not key:
+            # this is meant to support basic connect health checks
+            # (avoid having log garbage for healthcheck requests)
+            logger.info("Got empty request from client %s", conn.client_id)
+            self.close_connection(conn)
+            return
+        logger.debug("Got request %r from client %s", key, conn.client_id)
+        self.metrics.incr("requests")
+        if not wait:
+            conn.inflight -= 1
+        if key in self.queues:
+            workspace = self.queues[key]
+            self.metrics.incr("collapsed_requests")
+            if workspace.held:
+                workspace.arrivals.append(monotonic())
+        else:
+            if self.results is not None:
+                result = self.results.get(key)
+                if result is not None:
+                    logger.debug("Passing back cached result of task %r to %s", result.pid, conn.client_id)
+                    self.metrics.incr("cache_hits")
+                    if wait:
+                        self.send_response(conn, request_id, result.exit_code, result.pid, result.payload)
+                    return
+            workspace = self.queues.setdefault(key, Workspace(key, payload))
+        if wait and stale and self.results is not None:
+            result = self.results.peek(key)
+            if result is not None and not result.exit_code:
+                # answer with the last good result and let the task run (or keep running) in the background
+                logger.debug("Passing back stale result of task %r to %s", result.pid, conn.client_id)
+                self.metrics.incr("stale_responses")
+                self.send_response(conn, request_id, result.exit_code, result.pid, result.payload, time() - result.finished)
+                wait = False
+        if wait:
+            workspace.clients.append((conn, request_id))
+        self.process_workspace(workspace)
+
+    def handle_timeouts(self):
+        now = monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, conn = self.deadlines.popleft()
+            if conn.deadline is not None and not conn.closed:
+                logger.error("Failed to read request from client %s: timed out", conn.client_id)
+                self.close_connection(conn)
+        if self.task_deadlines and self.task_deadlines[0][0] <= now:
+            while self.task_deadlines and self.task_deadlines[0][0] <= now:
+                _, _, task_id, workspace = heapq.heappop(self.task_deadlines)
+                # the task might have completed already (and its id reused)
+                if self.tasks.get(task_id) is workspace:
+                    self.expire_task(task_id, now)
+            self.flush_responses()
+            self.process_pending()
+        while self.held and self.held[0][0] <= now:
+            _, _, workspace = heapq.heappop(self.held)
+            workspace.held = False
+            logger.info("Releasing %s (%s requests arrived while held)", workspace, len(workspace.arrivals))
             self.process_workspace(workspace)
+
+    def expire_task(self, task_id, now):
+        workspace = self.tasks[task_id]
+        logger.error("Task %r for %s timed out after %.3fs", task_id, workspace, now - workspace.started_at)
+        pid = self.executor.cancel(task_id)
+        self.metrics.incr("tasks_timed_out")
+        self.finish_task(task_id, TIMEOUT_EXIT_CODE, pid)
+
+    def next_timeout(self):
+        timeout = 1
+        if self.deadlines:
+            timeout = min(timeout, self.deadlines[0][0] - monotonic())
+        if self.task_deadlines:
+            timeout = min(timeout, self.task_deadlines[0][0] - monotonic())
+        if self.held:
+            timeout = min(timeout, self.held[0][0] - monotonic())
+        return max(0, timeout)
+
+    def handle_accept(self, requests_sock):
+        # the listening socket is non-blocking so a burst of clients is accepted in a single wakeup - but with shards
+        # only one of them is woken up (EPOLLEXCLUSIVE) so it shouldn't take the whole burst
+        deadline = monotonic() + self.request_timeout
+        for _ in range(self.shard_accepts) if self.shards else itertools.count():
+            try:
+                client_sock, _ = requests_sock.accept()
+            except socket.error as exc:
+                if would_block(exc):
+                    return
+                if exc.errno == errno.ECONNABORTED:
+                    continue
+                # eg: EMFILE - the connection stays in the backlog until an fd is freed
+                logger.error("Failed to accept connection: %s", exc)
+                return
+            if IS_PY2:
+                # Python 3 uses accept4 with SOCK_CLOEXEC
+                cloexec(client_sock)
+            pid, uid, gid = struct.unpack(b"3i", client_sock.getsockopt(
+                socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize(b"3i")
+            ))
+            conn = Connection(client_sock, ClientId(uid, pid), deadline)
+            self.metrics.incr("accepts")
+            self.deadlines.append((deadline, conn))
+            self.update_events(conn)
+
+    def handle_metrics_accept(self):
+        deadline = monotonic() + self.request_timeout
+        while True:
+            try:
+                sock, _ = self.metrics_sock.accept()
+            except socket.error as exc:
+                if would_block(exc):
+                    return
+                if exc.errno == errno.ECONNABORTED:
+                    continue
+                logger.error("Failed to accept metrics connection: %s", exc)
+                return
+            cloexec(sock)
+            conn = Connection(sock, "metrics", deadline)
+            self.deadlines.append((deadline, conn))
+            self.add_reader(sock, lambda conn=conn: self.handle_metrics_request(conn))
+
+    def handle_metrics_request(self, conn):
+        try:
+            conn.fill()
+        except Exception as exc:
+            logger.debug("Failed to read metrics request: %s", exc)
+            self.remove_reader(conn.sock)
+            conn.close()
+            return
+        # the request is only read to the end of the headers (there's only one thing to serve) but it must be read:
+        # closing a unix socket with unread data resets the connection and the client could miss the response
+        if b"\r\n\r\n" not in conn.rbuf and b"\n\n" not in conn.rbuf and not conn.eof:
+            if len(conn.rbuf) < conn.max_line_length:
+                return
+        self.remove_reader(conn.sock)
+        conn.deadline = None
+        body = self.metrics.format_prometheus().encode("ascii")
+        conn.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n" % len(body))
+        conn.write(body)
+        conn.reading = False
+        conn.closing = True
+        self.unflushed.add(conn)
+        self.flush_responses()
+
+    def listen(self, socket_path):
+        sock = cloexec(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        logger.info("Binding to %r", socket_path)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        pending_socket_path = "%s-pending" % socket_path
+        sock.bind(pending_socket_path)
+        sock.listen(self.socket_backlog or get_somaxconn())
+        os.rename(pending_socket_path, socket_path)
+        return sock
+
+    def bind(self):
+        sock = self.inherit_socket()
+        if sock is None:
+            if self.handoff and self.instance_lock is None:
+                sock = self.receive_handoff()
+            else:
+                sock = self.listen(self.socket_path)
+        sock.setblocking(False)
+        self.notify_ready()
+        return sock
+
+    def get_connections(self):
+        connections = {}
+        for conn in self.clients.values():
+            connections[id(conn)] = conn
+        for workspace in self.queues.values():
+            for conn, _ in workspace.clients:
+                connections[id(conn)] = conn
+        return [conn for conn in connections.values() if not conn.closed]
+
+    def send_handoff(self, conn):
+        """
+        Passes the listening socket, the clients, the queues and the cached results to the worker on the other end of
+        ``conn`` (see :meth:`receive_handoff`). Tasks that already started keep running here: their results are
+        forwarded to the new worker and the loop stops after the last one completes.
+        """
+        if self.shards:
+            raise ProtocolError("Sharded workers can't be taken over")
+        if conn.client_id.uid != os.getuid():
+            raise ProtocolError("Client %s is not allowed to take over" % conn.client_id)
+        logger.info("Handing off to %s ...", conn.client_id)
+        connections = []
+        for item in self.get_connections():
+            if item is conn:
+                continue
+            elif isinstance(item.client_id, ClientId):
+                connections.append(item)
+            else:
+                # a metrics connection still writing its response, it's not a client the new worker could serve
+                self.close_connection(item)
+        indexes = dict((id(item), index) for index, item in enumerate(connections))
+        task_ids = dict((id(workspace), task_id) for task_id, workspace in self.tasks.items())
+        now = time()
+        conn.write(encode_line({"op": "listener"}), [self.requests_sock])
+        for item in connections:
+            message = {
+                "op": "connection",
+                "uid": item.client_id.uid,
+                "pid": item.client_id.pid,
+                "version": item.version,
+                "inflight": item.inflight,
+                "reading": item.reading,
+                "eof": item.eof,
+                "closing": item.closing,
+                "deadline": item.deadline is not None,
+                "shared": sorted(item.shared),
+                "input": len(item.rbuf),
+                "output": len(item.wbuf),
+                "files": [[offset - item.written, len(files)] for offset, files in item.wfds],
+            }
+            if item.message is not None:
+                message["message"] = item.message[0]
+            files = [item.sock]
+            for _, attached in item.wfds:
+                files.extend(attached)
+            conn.write(encode_line(message) + bytes(item.rbuf) + bytes(item.wbuf), files)
+        for workspace in self.queues.values():
+            message = {
+                "op": "workspace",
+                "key": encode_key(workspace.key),
+                "clients": [[indexes[id(item)], request_id] for item, request_id in workspace.clients if id(item) in indexes],
+            }
+            if workspace.started:
+                message["task"] = task_ids[id(workspace)]
+                message["age"] = monotonic() - workspace.started_at
+            conn.write(encode_frame(message, workspace.payload))
+        if self.results is not None:
+            for key, entry in self.results.entries.items():
+                message = {"op": "result", "key": encode_key(key), "exit_code": entry.exit_code, "pid": entry.pid,
+                           "age": now - entry.finished}
+                if isinstance(entry.payload, SharedResult):
+                    message["shared"] = entry.payload.size
+                    conn.write(encode_line(message), [entry.payload])
+                else:
+                    conn.write(encode_frame(message, entry.payload))
+        conn.write(encode_line({"op": "end"}))
+        # this worker is done serving so just block until the new one got everything
+        conn.sock.settimeout(self.handoff_timeout)
+        try:
+            conn.flush()
+        except Exception as exc:
+            logger.error("Failed to hand off to %s: %s", conn.client_id, exc)
+            self.close_connection(conn)
+            return
+        conn.sock.setblocking(False)
+
+        for item in connections:
+            item.reading = False
+            del item.wbuf[:]
+            self.update_events(item)
+            item.detach()
+        for workspace in list(self.queues.values()):
+            del workspace.clients[:]
+            if not workspace.started:
+                del self.queues[workspace.key]
+        del self.pending[:]
+        del self.held[:]
+        self.deadlines.clear()
+        if self.results is not None:
+            self.results.close()
+            self.results = None
+        self.poller.unregister(self.requests_sock)
+        self.requests_sock.close()
+        conn.reading = False
+        self.update_events(conn)
+        self.successor = conn
+        logger.info("Handed off %s connections to %s, waiting for %s running tasks", len(connections), conn.client_id,
+                    self.running_count)
+
+    def forward_result(self, task_id, exit_code, pid, result):
+        conn = self.successor
+        if conn.closed:
+            return
+        message = {"op": "completed", "task": task_id, "exit_code": exit_code, "pid": pid}
+        if isinstance(result, SharedResult):
+            message["shared"] = result.size
+            conn.write(encode_line(message), [result])
+        else:
+            conn.write(encode_frame(message, result))
+        self.unflushed.add(conn)
+
+    def end_handoff(self):
+        conn = self.successor
+        logger.info("All the tasks running at handoff completed")
+        if not conn.closed:
+            conn.sock.settimeout(self.handoff_timeout)
+            try:
+                conn.flush()
+            except Exception as exc:
+                logger.error("Failed to forward results to %s: %s", conn.client_id, exc)
+            self.close_connection(conn)
+
+    def receive_handoff(self):
+        """
+        Takes over from the running worker (see :meth:`send_handoff`) and returns its listening socket. Tasks that it
+        already started are not run again: their results are passed back when the old worker forwards them.
+        """
+        # spawners that don't find the instance lock (after the old worker exits but before this one gets the lock)
+        # wait on this and then find this worker running
+        self.spawn_lock = SpawnLock(self.path).acquire()
+        conn = HandoffConnection(self.path, self.handoff_timeout)
+        try:
+            conn.sock.sendall(encode_handoff_request(1))
+            hello = conn.readline()
+            if hello.get("version") != VERSION:
+                raise ProtocolError("Unsupported protocol: %r" % hello)
+            listener = None
+            while True:
+                message = conn.readline()
+                op = message.get("op")
+                if op == "listener":
+                    listener = conn.read_socket()
+                elif op == "connection":
+                    self.inherit_connection(conn, message)
+                elif op == "workspace":
+                    self.inherit_workspace(conn, message)
+                elif op == "result":
+                    self.inherit_result(conn, message)
+                elif op == "end":
+                    break
+                else:
+                    raise ProtocolError("Unexpected handoff message %r" % message)
+            if listener is None:
+                raise ProtocolError("Missing listener")
         except Exception:
-            logger.exception("Failed to read request from client %s", client_id)
-            close(conn, fd)
+            conn.close()
             raise
+        self.predecessor = conn
+        logger.info("Took over %s connections and %s workspaces (%s tasks still running in the old worker)",
+                    len(self.inherited), len(self.queues), len(self.tasks))
+        return listener
 
-    def handle_accept(self, requests_sock):
-        client_sock, _ = requests_sock.accept()
-        cloexec(client_sock)
-        pid, uid, gid = struct.unpack(b"3i", client_sock.getsockopt(
-            socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize(b"3i")
-        ))
-        client_sock.settimeout(1)  # fail fast as .readline() can block
-        self.clients[client_sock] = client_sock.makefile("rwb"), "%s:%s" % (pwd.getpwuid(uid).pw_name, pid)
+    def inherit_connection(self, conn, message):
+        item = Connection(conn.read_socket(), ClientId(message["uid"], message["pid"]))
+        item.version = message["version"]
+        item.inflight = message["inflight"]
+        item.reading = message["reading"]
+        item.eof = message["eof"]
+        item.closing = message["closing"]
+        item.shared = set(message["shared"])
+        item.rbuf.extend(conn.read_exactly(message["input"]))
+        item.wbuf.extend(conn.read_exactly(message["output"]))
+        for offset, count in message["files"]:
+            item.wfds.append((offset, [conn.read_file() for _ in range(count)]))
+        if "message" in message:
+            item.message = message["message"], decode_key(message["message"]["key"])
+        if message["deadline"]:
+            item.deadline = monotonic() + self.request_timeout
+            self.deadlines.append((item.deadline, item))
+        self.inherited.append(item)
 
-    def run(self):
-        child_fd = signalfd.signalfd(-1, [signal.SIGCHLD], signalfd.SFD_NONBLOCK | signalfd.SFD_CLOEXEC)
-        with os.fdopen(child_fd, "rb") as child_signals:
-            signalfd.sigprocmask(signalfd.SIG_BLOCK, [signal.SIGCHLD])
-            with closing(cloexec(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))) as requests_sock:
-                logger.info("Binding to %r", self.socket_path)
-                if os.path.exists(self.socket_path):
-                    os.unlink(self.socket_path)
-                pending_socket_path = "%s-pending" % self.socket_path
-                requests_sock.bind(pending_socket_path)
-                requests_sock.listen(self.socket_backlog)
-                os.rename(pending_socket_path, self.socket_path)
+    def inherit_workspace(self, conn, message):
+        workspace = Workspace(decode_key(message["key"]), conn.read_exactly(message["size"]) if "size" in message else None)
+        workspace.clients = [(self.inherited[index], request_id) for index, request_id in message["clients"]]
+        if "task" in message:
+            workspace.started = True
+            workspace.started_at = monotonic() - message["age"]
+            self.tasks[("handoff", message["task"])] = workspace
+        self.queues[workspace.key] = workspace
+
+    def inherit_result(self, conn, message):
+        if "shared" in message:
+            payload = conn.read_file()
+        elif "size" in message:
+            payload = conn.read_exactly(message["size"])
+        else:
+            payload = None
+        if self.results is not None:
+            self.results.set(decode_key(message["key"]), message["exit_code"], message["pid"], payload,
+                             time() - message["age"])
+
+    def resume_handoff(self):
+        if self.predecessor is None:
+            return
+        for conn in self.inherited:
+            self.update_events(conn)
+        del self.inherited[:]
+        for workspace in list(self.queues.values()):
+            self.process_workspace(workspace)
+        self.add_reader(self.predecessor.sock, self.handle_predecessor)
+
+    def handle_predecessor(self):
+        conn = self.predecessor
+        try:
+            conn.fill()
+        except Exception as exc:
+            # the old worker closes the connection after its last task
+            logger.debug("Connection to the old worker closed: %s", exc)
+            self.release_predecessor()
+            return
+        for message in conn.read_available():
+            if message.get("op") != "completed":
+                logger.warning("Unexpected handoff message %r", message)
+                continue
+            task_id = "handoff", message["task"]
+            result = conn.read_file() if "shared" in message else message.get("payload")
+            if task_id in self.tasks:
+                self.finish_task(task_id, message["exit_code"], message["pid"], result)
+        self.flush_responses()
+        self.process_pending()
+
+    def release_predecessor(self):
+        self.remove_reader(self.predecessor.sock)
+        self.predecessor.close()
+        self.predecessor = None
+        for task_id, workspace in list(self.tasks.items()):
+            if isinstance(task_id, tuple):
+                logger.error("Lost task %r for %s (the old worker exited), running it again", task_id[1], workspace)
+                del self.tasks[task_id]
+                workspace.started = False
+                self.process_workspace(workspace)
+        self.instance_lock = FileLock(self.path)
+        self.instance_lock.acquire(blocking=True)
+        self.spawn_lock.release()
+        logger.info("Handoff completed")
+
+    def start_shards(self):
+        """
+        Forks ``shards`` event loops that accept clients from the same socket. Every key is owned by one shard (see
+        :meth:`get_shard`) that runs its tasks, the other shards forward their requests for it and pass the results back
+        to their clients - so a key still has at most one running task. Returns ``True`` in the shards, the original
+        process just supervises them and returns ``False`` after they exit.
+        """
+        # pairs[i, j] connects shard i (forwarding, first socket) to shard j (owner, second socket)
+        pairs = dict(((i, j), socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM))
+                     for i in range(self.shards) for j in range(self.shards) if i != j)
+        # only the supervisor keeps the write end open
+        supervisor_fd, alive_fd = os.pipe()
+        if self.state_signal:
+            # until the shards read it from their signalfd it stays pending instead of killing them
+            signalfd.sigprocmask(signalfd.SIG_BLOCK, [self.state_signal])
+        pids = {}
+        for shard in range(self.shards):
+            pid = os.fork()
+            if not pid:
+                os.close(alive_fd)
+                self.supervisor_fd = cloexec(supervisor_fd)
+                self.shard = shard
+                self.peers = [None] * self.shards
+                self.peer_clients = []
+                for (i, j), (forwarding, owner) in pairs.items():
+                    if i == shard:
+                        self.peers[j] = PeerConnection(cloexec(forwarding), j)
+                    else:
+                        forwarding.close()
+                    if j == shard:
+                        self.peer_clients.append(Connection(cloexec(owner), "shard-%s" % i))
+                    else:
+                        owner.close()
+                return True
+            pids[pid] = shard
+        for forwarding, owner in pairs.values():
+            forwarding.close()
+            owner.close()
+        os.close(supervisor_fd)
+        logger.info("Started %s shards: %s", self.shards, ", ".join(str(pid) for pid in sorted(pids)))
+        try:
+            self.supervise(pids)
+        finally:
+            os.close(alive_fd)
+        return False
+
+    def supervise(self, pids):
+        """
+        Waits for the shards to exit. ``SIGTERM``, ``SIGINT`` and the ``state_signal`` are passed to them and if a shard
+        exits the others are stopped too (the keys it owned couldn't run anymore).
+        """
+        def forward(signum, _frame=None):
+            for pid in list(pids):
                 try:
-                    while 1:
-                        qlen = len(self.queues)
-                        logger.debug("Queues => %s workspaces", qlen)
-                        for i, wq in enumerate(self.queues.values()):
-                            if i + 1 == qlen:
-                                logger.debug(" \_ %s", wq)
-                            else:
-                                logger.debug(" |_ %s", wq)
-
-                        current_fds = [child_fd, requests_sock]
-                        current_fds.extend(self.clients.keys())
-                        read_ready, _, errors = select.select(current_fds, [], current_fds, 1)
-                        for fd in read_ready:
-                            if requests_sock == fd:
-                                self.handle_accept(requests_sock)
-                            elif fd in self.clients:
-                                self.handle_request(fd)
-                            elif fd == child_fd:
-                                self.handle_signal(child_signals)
-                        for fd in errors:
-                            logger.error("Fd %r has error !", fd)
-                finally:
-                    for fd, (fh, _) in self.clients.items():
-                        close(fh, fd)
+                    os.kill(pid, signum)
+                except OSError as exc:
+                    logger.debug("Failed to signal shard %s: %s", pids.get(pid), exc)
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        if self.state_signal:
+            # every shard logs its own state
+            signal.signal(self.state_signal, forward)
+            signalfd.sigprocmask(signalfd.SIG_UNBLOCK, [self.state_signal])
+        stopping = False
+        while pids:
+            try:
+                pid, status = os.wait()
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            shard = pids.pop(pid, None)
+            if shard is not None and not stopping:
+                logger.error("Shard %s (pid %s) exited with status %s, stopping the other shards", shard, pid, status)
+                stopping = True
+                forward(signal.SIGTERM)
+
+    def handle_supervisor_exit(self):
+        # nothing is ever written to it so this is EOF: without the supervisor the instance lock is gone and another
+        # worker could be started for the same path
+        logger.critical("Supervisor exited, stopping shard %s", self.shard)
+        raise SystemExit(1)
+
+    def start_peers(self):
+        for peer in self.peers:
+            if peer is not None:
+                peer.write(HANDSHAKE + b"\n")
+                self.add_reader(peer.sock, lambda peer=peer: self.handle_peer(peer))
+                peer.events = READ
+                self.flush_peer(peer)
+        for conn in self.peer_clients:
+            self.update_events(conn)
+        self.peer_clients = ()
+
+    def forward_task(self, workspace, peer):
+        workspace.started = True
+        workspace.started_at = monotonic()
+        request_id = next(peer.counter)
+        peer.requests[request_id] = workspace
+        peer.write(encode_request(request_id, workspace.key, payload=workspace.payload, shared=hasattr(peer.sock, "recvmsg")))
+        self.unflushed_peers.add(peer)
+        self.metrics.incr("forwarded_tasks")
+        logger.info("Forwarded %s to shard %s", workspace, peer.shard)
+
+    def flush_peer(self, peer):
+        events = READ if peer.flush() else READ | WRITE
+        if events != peer.events:
+            self.poller.modify(peer.sock, events)
+            peer.events = events
+
+    def handle_peer(self, peer):
+        if peer.wbuf:
+            self.flush_peer(peer)
+        peer.fill()
+        for message, result in peer.read_responses():
+            if "id" not in message:
+                if message.get("version") != VERSION:
+                    raise ProtocolError("Unsupported protocol: %r" % message)
+                continue
+            workspace = peer.requests.pop(message["id"])
+            self.queues.pop(workspace.key)
+            logger.info("Shard %s completed task %r. Passing back results to [%s]", peer.shard, message["pid"],
+                        workspace.formatted_clients)
+            if self.results is not None and message["exit_code"] != TIMEOUT_EXIT_CODE:
+                # so this shard can answer cached and stale requests for the key too
+                self.results.set(workspace.key, message["exit_code"], message["pid"], result)
+            self.pass_back(workspace, message["exit_code"], message["pid"], result)
+        if peer.eof:
+            raise RuntimeError("Lost connection to shard %s" % peer.shard)
+        self.flush_responses()
+
+    def open_result_store(self):
+        """
+        Opens the result store (after a handoff: once the old worker stopped writing in it).
+        """
+        if self.result_store_path and self.results is not None:
+            if self.shards:
+                # every shard has its own keys
+                path = "%s.%s" % (self.result_store_path, self.shard)
+            else:
+                path = self.result_store_path
+            self.results.store = ResultStore(path)
+            logger.info("Using %s", self.results.store)
+
+    def compact_results(self, idle):
+        store = None if self.results is None else self.results.store
+        if store is not None and store.should_compact(idle):
+            try:
+                store.compact()
+            except Exception:
+                # eg: disk full - the log just stays as it is
+                logger.exception("Failed to compact %s", store)
+
+    def inherit_socket(self):
+        """
+        Returns the listening socket passed by a supervisor (the ``listen_fd`` argument or systemd-style socket
+        activation) or ``None``. The supervisor keeps the socket open so clients queue in its backlog while the
+        worker restarts instead of getting refused.
+        """
+        fds = get_listen_fds() if self.listen_fd is None else [self.listen_fd]
+        if not fds:
+            return None
+        if len(fds) > 1:
+            logger.warning("Got %s sockets, only the first one is used", len(fds))
+        sock = cloexec(socket.fromfd(fds[0], socket.AF_UNIX, socket.SOCK_STREAM))
+        os.close(fds[0])
+        if not sock.getsockopt(socket.SOL_SOCKET, SO_ACCEPTCONN):
+            sock.close()
+            raise RuntimeError("Inherited fd %s is not a listening socket!" % fds[0])
+        logger.info("Using inherited socket bound to %r", sock.getsockname())
+        return sock
+
+    def notify_ready(self):
+        """
+        Tells the spawner (see :func:`stampede.client.spawn`) that the socket is ready. The fd is closed right away so
+        the executor and the tasks don't inherit it.
+        """
+        fd = os.environ.pop(READY_FD_ENV, None)
+        if fd is None or not fd.isdigit():
+            return
+        fd = int(fd)
+        try:
+            write_all(fd, b"\n")
+        except OSError as exc:
+            # eg: the spawner gave up waiting
+            logger.warning("Failed to notify the spawner: %s", exc)
+        finally:
+            close(fd)
+
+    def start_metrics(self):
+        if self.metrics_socket_path:
+            if self.shards:
+                # every shard has its own metrics
+                self.metrics_sock = self.listen("%s.%s" % (self.metrics_socket_path, self.shard))
+            else:
+                self.metrics_sock = self.listen(self.metrics_socket_path)
+            self.metrics_sock.setblocking(False)
+            self.add_reader(self.metrics_sock, self.handle_metrics_accept)
+
+    def stop_metrics(self):
+        if self.metrics_sock is not None:
+            self.remove_reader(self.metrics_sock)
+            self.metrics_sock.close()
+
+    def handle_event(self, fd, events):
+        if self.requests_sock == fd:
+            self.handle_accept(self.requests_sock)
+        elif fd in self.clients:
+            conn = self.clients[fd]
+            if conn.reading and events & (READ | ERROR):
+                self.handle_request(conn)
+            # a client can still be sending requests while a response too big for a single send is pending
+            if events & (WRITE | ERROR) and conn.wbuf and not conn.closed:
+                self.handle_write(conn)
+        elif fd in self.handlers:
+            self.handlers[fd]()
+        else:
+            # eg: a result pipe that got drained and closed by an earlier event from the same poll() batch
+            logger.debug("Ignoring events %s for unregistered fd %r", events, fd)
+
+    def log_state(self):
+        qlen = len(self.queues)
+        logger.info("Queues => %s workspaces (%s running, %s pending)", qlen, self.running_count, self.pending_count)
+        for i, wq in enumerate(self.queues.values()):
+            if i + 1 == qlen:
+                logger.info(" \\_ %s", wq)
+            else:
+                logger.info(" |_ %s", wq)
+        if self.results is not None:
+            logger.info("Results => %s", self.results)
+
+    def log_state_periodically(self):
+        if self.state_log_interval is not None:
+            now = monotonic()
+            if now >= self.next_state_log:
+                self.next_state_log = now + self.state_log_interval
+                self.log_state()
+
+    def handle_state_signal(self):
+        if read_signals(self.state_signal_fd):
+            self.log_state()
+
+    def start_state_signal(self):
+        if self.state_signal:
+            self.state_signal_fd = signalfd.signalfd(-1, [self.state_signal], signalfd.SFD_NONBLOCK | signalfd.SFD_CLOEXEC)
+            signalfd.sigprocmask(signalfd.SIG_BLOCK, [self.state_signal])
+            self.add_reader(self.state_signal_fd, self.handle_state_signal)
+
+    def stop_state_signal(self):
+        if self.state_signal:
+            self.remove_reader(self.state_signal_fd)
+            close(self.state_signal_fd)
+
+    def add_reader(self, fd, callback):
+        self.poller.register(fd, READ)
+        self.handlers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.poller.unregister(fd)
+        del self.handlers[fd]
+
+    def close_connections(self):
+        for conn in list(self.clients.values()):
+            conn.close()
+        for peer in self.peers:
+            if peer is not None:
+                peer.close()
+        for workspace in self.queues.values():
+            for conn, _ in workspace.clients:
+                conn.close()
+
+    def run(self):
+        self.warm_up()
+        with closing(self.bind()) as self.requests_sock:
+            if self.shards and not self.start_shards():
+                return
+            self.open_result_store()
+            self.executor = self.create_executor()
+            self.executor.start()
+            self.poller = self.poller_class()
+            self.poller.register(self.executor.fd, READ)
+            # with shards only one of them is woken up for a new connection
+            self.poller.register(self.requests_sock, READ | EXCLUSIVE if self.shards else READ)
+            self.start_metrics()
+            self.start_state_signal()
+            self.start_peers()
+            if self.supervisor_fd is not None:
+                self.add_reader(self.supervisor_fd, self.handle_supervisor_exit)
+            self.resume_handoff()
+            logger.info("Ready to accept requests on %r", self.socket_path)
+            try:
+                while self.successor is None or self.tasks:
+                    self.log_state_periodically()
+                    ready = self.poller.poll(self.next_timeout())
+                    for fd, events in ready:
+                        if fd == self.executor.fd:
+                            self.handle_completions()
+                        else:
+                            self.handle_event(fd, events)
+                    self.handle_timeouts()
+                    self.compact_results(idle=not ready)
+                self.end_handoff()
+            finally:
+                self.stop_state_signal()
+                self.stop_metrics()
+                self.close_connections()
+                self.poller.close()
+                self.executor.shutdown()
+                if self.results is not None:
+                    self.results.close()
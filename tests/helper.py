@@ -1,9 +1,17 @@
+import errno
+import gc
+import json
 import logging
 import os
+import signal
+import socket
 import sys
+import threading
 import time
+from contextlib import closing
 
 from stampede import StampedeWorker
+from stampede import executors
 
 try:
     from pytest_cov.embed import cleanup
@@ -13,14 +21,68 @@ except ImportError:
 
 
 PATH = '/tmp/stampede-tests'
+METRICS_PATH = '/tmp/stampede-tests-metrics.sock'
+RESULTS_PATH = '/tmp/stampede-tests-results'
+
+
+class LegacyWorker(threading.Thread):
+    """
+    Serves like the workers of stampede 1.x: a single "key\\n" request per connection, stripped, empty ones are closed.
+    """
+    def __init__(self, path):
+        super(LegacyWorker, self).__init__()
+        self.daemon = True
+        self.keys = []
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists('%s.sock' % path):
+            os.unlink('%s.sock' % path)
+        self.sock.bind('%s.sock' % path)
+        self.sock.listen(16)
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            with closing(conn):
+                key = conn.makefile('rb').readline().strip()
+                if key:
+                    self.keys.append(key)
+                    conn.sendall(json.dumps({'exit_code': 1 if key == b'fail' else 0, 'pid': 123}).encode('ascii'))
+
+    def close(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+
+class FailingForkExecutor(executors.ForkExecutor):
+    def submit(self, key, payload=None):
+        if key.startswith(b'fail'):
+            raise OSError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        return super(FailingForkExecutor, self).submit(key, payload)
 
 
 class MockedStampedeWorker(StampedeWorker):
     alarm_time = 1
 
-    def handle_task(self, workspace_name):
+    def preload(self):
+        if sys.argv[1] == 'preload':
+            import decimal  # noqa
+            logging.critical('PRELOADING')
+
+    def get_priority(self, key):
+        return -1 if key.startswith(b'urgent') else 0
+
+    def get_timeout(self, key):
+        return 0.3 if key.startswith(b'short') else self.alarm_time
+
+    def get_delay(self, key):
+        return None if key.startswith(b'now') else self.coalesce_delay
+
+    def handle_task(self, workspace_name, payload=None):
         entrypoint = sys.argv[1]
-        if entrypoint == 'simple':
+        if entrypoint in ('simple', 'cached', 'submit_fail'):
             logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
         elif entrypoint == 'fail':
             raise Exception('FAIL')
@@ -29,11 +91,52 @@ class MockedStampedeWorker(StampedeWorker):
             time.sleep(0.35)
             logging.critical('queue_collapse OK')
         elif entrypoint == 'timeout':
+            if workspace_name == b'alarm':
+                # a task's own SIGALRM is just a failure
+                signal.signal(signal.SIGALRM, signal.SIG_DFL)
+                os.kill(os.getpid(), signal.SIGALRM)
             logging.critical('timeout STARTED')
             time.sleep(2)
             logging.critical('timeout FAIL')
         elif entrypoint == 'custom_exit_code':
             raise SystemExit(123)
+        elif entrypoint == 'max_tasks':
+            logging.critical('JOB %s STARTED', workspace_name.decode('ascii'))
+            time.sleep(0.2)
+        elif entrypoint == 'sleep':
+            time.sleep(float(workspace_name))
+            logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
+        elif entrypoint in ('payload', 'shared'):
+            time.sleep(0.2)
+            logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
+            return payload * int(workspace_name)
+        elif entrypoint == 'preload':
+            assert 'decimal' in sys.modules
+            assert not hasattr(gc, 'get_freeze_count') or gc.get_freeze_count()
+            logging.critical('JOB %s PRELOADED', workspace_name.decode('ascii'))
+        elif entrypoint == 'stale':
+            time.sleep(0.3)
+            logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
+            return repr(time.time()).encode('ascii')
+        elif entrypoint == 'stored':
+            logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
+            return workspace_name * 2
+        elif entrypoint == 'sharded':
+            time.sleep(0.3)
+            logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
+            return workspace_name * 2
+        elif entrypoint == 'coalesce':
+            time.sleep(0.05)
+            logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
+            return repr(time.time()).encode('ascii')
+        elif entrypoint == 'slot':
+            logging.critical('JOB %s STARTED', workspace_name.decode('ascii'))
+            time.sleep(float(workspace_name.split(b':')[1]))
+            logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
+        elif entrypoint == 'signal':
+            signal.signal(signal.SIGUSR1, lambda *args: logging.critical('JOB %s GOT SIGUSR1', workspace_name.decode('ascii')))
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.1)
         elif entrypoint == 'bad_client':
             logging.critical('JOB %s EXECUTED', workspace_name)
             time.sleep(0.1)
@@ -47,6 +150,30 @@ if __name__ == '__main__':
         format='[pid=%(process)d - %(asctime)s]: %(name)s - %(levelname)s - %(message)s',
     )
 
-    daemon = MockedStampedeWorker(PATH)
+    if sys.argv[1] == 'max_tasks':
+        MockedStampedeWorker.max_tasks = 1
+        MockedStampedeWorker.state_log_interval = 0
+    elif sys.argv[1] in ('cached', 'timeout'):
+        MockedStampedeWorker.result_ttl = 5
+    elif sys.argv[1] == 'sleep':
+        MockedStampedeWorker.metrics_socket_path = METRICS_PATH
+    elif sys.argv[1] == 'shared':
+        MockedStampedeWorker.shared_results = True
+    elif sys.argv[1] == 'stale':
+        MockedStampedeWorker.result_ttl = 0.5
+    elif sys.argv[1] == 'stored':
+        MockedStampedeWorker.result_ttl = 60
+        MockedStampedeWorker.result_store_path = RESULTS_PATH
+    elif sys.argv[1] == 'sharded':
+        MockedStampedeWorker.shards = 4
+    elif sys.argv[1] == 'slot':
+        MockedStampedeWorker.max_tasks = 1
+    elif sys.argv[1] == 'coalesce':
+        MockedStampedeWorker.coalesce_delay = 0.3
+    elif sys.argv[1] == 'submit_fail':
+        MockedStampedeWorker.executor_class = FailingForkExecutor
+    if len(sys.argv) > 2:
+        MockedStampedeWorker.executor_class = getattr(executors, sys.argv[2])
+    daemon = MockedStampedeWorker(PATH, handoff=sys.argv[3:] == ['handoff'])
     daemon.run()
     logging.info("DONE.")
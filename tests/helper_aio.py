@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import sys
+
+from stampede.aio import AsyncStampedeWorker
+
+import helper
+
+
+class MockedAsyncStampedeWorker(AsyncStampedeWorker):
+    alarm_time = 1
+
+    async def handle_task(self, workspace_name):
+        entrypoint = sys.argv[1]
+        if entrypoint == 'simple':
+            await asyncio.sleep(float(workspace_name))
+            logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
+        elif entrypoint == 'fail':
+            raise Exception('FAIL')
+        elif entrypoint == 'exit':
+            if workspace_name == b'base':
+                raise GeneratorExit()
+            sys.exit(int(workspace_name) if workspace_name.isdigit() else workspace_name.decode('ascii'))
+        elif entrypoint == 'stored':
+            logging.critical('JOB %s EXECUTED', workspace_name.decode('ascii'))
+            return workspace_name * 2
+        elif entrypoint == 'timeout':
+            logging.critical('timeout STARTED')
+            await asyncio.sleep(2)
+            logging.critical('timeout FAIL')
+        else:
+            raise RuntimeError('Invalid test spec %r.' % entrypoint)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='[pid=%(process)d - %(asctime)s]: %(name)s - %(levelname)s - %(message)s',
+    )
+
+    if sys.argv[1] == 'stored':
+        MockedAsyncStampedeWorker.result_ttl = 60
+        MockedAsyncStampedeWorker.result_store_path = helper.RESULTS_PATH
+    daemon = MockedAsyncStampedeWorker(helper.PATH)
+    daemon.run()
+    logging.info("DONE.")
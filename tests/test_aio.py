@@ -0,0 +1,174 @@
+import os
+import signal
+import sys
+import time
+
+import psutil
+import pytest
+from process_tests import TestProcess
+from process_tests import dump_on_error
+from process_tests import wait_for_strings
+
+from stampede.client import TaskFailed
+from stampede.client import TaskTimeout
+from stampede.protocol import TIMEOUT_EXIT_CODE
+
+import helper
+
+asyncio = pytest.importorskip('asyncio')
+aio = pytest.importorskip('stampede.aio')
+helper_aio = pytest.importorskip('helper_aio')
+
+UDS_PATH = '%s.sock' % helper.PATH
+TIMEOUT = int(os.getenv('TEST_TIMEOUT', 5))
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def test_request(loop):
+    with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            results = loop.run_until_complete(asyncio.gather(*[
+                aio.request(helper.PATH, b"0.1") for _ in range(5)
+            ]))
+            assert len(set(results)) == 1
+            assert results[0].exit_code == 0
+            with pytest.raises(TaskFailed):
+                loop.run_until_complete(aio.request(helper.PATH, b"foo"))
+            assert loop.run_until_complete(aio.request(helper.PATH, b"0", wait=False)) is None
+
+
+def test_request_legacy_worker(loop, tmpdir):
+    path = str(tmpdir.join('legacy'))
+    worker = helper.LegacyWorker(path)
+    worker.start()
+    try:
+        assert loop.run_until_complete(aio.request(path, b"foo")) == (0, 123)
+        with pytest.raises(TaskFailed):
+            loop.run_until_complete(aio.request(path, b"fail"))
+        assert loop.run_until_complete(aio.request(path, b"bar", wait=False)) is None
+        while len(worker.keys) < 3:
+            time.sleep(0.01)
+        assert worker.keys == [b"foo", b"fail", b"bar"]
+    finally:
+        worker.close()
+        worker.join()
+
+
+def test_request_timeout(loop):
+    with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            with pytest.raises(asyncio.TimeoutError):
+                loop.run_until_complete(aio.request(helper.PATH, b"0.5", timeout=0.1))
+            wait_for_strings(proc.read, TIMEOUT, 'Failed to send response to')
+
+
+def test_request_and_spawn(loop):
+    if os.path.exists(UDS_PATH):
+        os.unlink(UDS_PATH)
+    try:
+        result = loop.run_until_complete(aio.request_and_spawn(
+            [sys.executable, helper.__file__, 'simple'], helper.PATH, b"foobar", timeout=TIMEOUT
+        ))
+        assert result.exit_code == 0
+    finally:
+        for child in psutil.Process(os.getpid()).children(recursive=True):
+            child.kill()
+            child.wait()
+
+
+def test_async_worker(loop):
+    with TestProcess(sys.executable, helper_aio.__file__, 'simple') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            results = loop.run_until_complete(asyncio.gather(
+                aio.request(helper.PATH, b"0.3"),
+                aio.request(helper.PATH, b"0.3"),
+                aio.request(helper.PATH, b"0.1"),
+            ))
+            assert results[0] == results[1] == results[2]
+            assert results[0].exit_code == 0
+            assert results[0].pid == proc.proc.pid
+            wait_for_strings(proc.read, TIMEOUT,
+                             'JOB 0.1 EXECUTED',
+                             'JOB 0.3 EXECUTED')
+            proc.proc.send_signal(signal.SIGUSR1)
+            wait_for_strings(proc.read, TIMEOUT, 'Queues => 0 workspaces')
+            assert proc.read().count('JOB 0.3 EXECUTED') == 1
+
+
+def test_async_worker_result_store(loop):
+    for suffix in '.log', '.idx':
+        if os.path.exists(helper.RESULTS_PATH + suffix):
+            os.unlink(helper.RESULTS_PATH + suffix)
+    for restart in range(2):
+        with TestProcess(sys.executable, helper_aio.__file__, 'stored') as proc:
+            with dump_on_error(proc.read):
+                wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+                assert loop.run_until_complete(aio.request(helper.PATH, b'foo')).result == b'foofoo'
+                if restart:
+                    wait_for_strings(proc.read, TIMEOUT, 'Passing back cached result')
+                    assert 'JOB foo EXECUTED' not in proc.read()
+                else:
+                    wait_for_strings(proc.read, TIMEOUT, 'JOB foo EXECUTED')
+
+
+def test_async_worker_fail(loop):
+    with TestProcess(sys.executable, helper_aio.__file__, 'fail') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            with pytest.raises(TaskFailed) as exc_info:
+                loop.run_until_complete(aio.request(helper.PATH, b"foobar"))
+            assert exc_info.value.exit_code == 255
+            wait_for_strings(proc.read, TIMEOUT, 'Failed task', 'Exception: FAIL')
+
+
+@pytest.mark.parametrize('key,exit_code', [
+    (b"3", 3),
+    (b"0", 0),
+    (b"message", 1),
+    (b"base", 255),
+])
+def test_async_worker_exit(loop, key, exit_code):
+    with TestProcess(sys.executable, helper_aio.__file__, 'exit') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            for _ in range(2):
+                if exit_code:
+                    with pytest.raises(TaskFailed) as exc_info:
+                        loop.run_until_complete(aio.request(helper.PATH, key))
+                    assert exc_info.value.exit_code == exit_code
+                else:
+                    assert loop.run_until_complete(aio.request(helper.PATH, key)).exit_code == 0
+            wait_for_strings(proc.read, TIMEOUT, 'Failed task')
+
+
+def test_async_worker_timeout(loop):
+    with TestProcess(sys.executable, helper_aio.__file__, 'timeout') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            with pytest.raises(TaskFailed) as exc_info:
+                loop.run_until_complete(aio.request(helper.PATH, b"foobar"))
+            assert isinstance(exc_info.value, TaskTimeout)
+            assert exc_info.value.exit_code == TIMEOUT_EXIT_CODE
+            wait_for_strings(proc.read, TIMEOUT, 'timeout STARTED', 'Timed out task')
+            assert 'timeout FAIL' not in proc.read()
+
+
+def test_async_worker_shards(tmpdir):
+    class ShardedWorker(aio.AsyncStampedeWorker):
+        shards = 2
+
+    ShardedWorker._SingleInstanceMeta__inst = None
+    with pytest.raises(RuntimeError) as exc_info:
+        ShardedWorker(str(tmpdir.join('worker')))
+    assert str(exc_info.value) == 'Shards are not supported by ShardedWorker'
@@ -0,0 +1,32 @@
+from stampede.cache import ResultCache
+
+
+def test_ttl():
+    cache = ResultCache(10)
+    cache.set(b'foo', 0, 123, finished=100)
+    assert cache.get(b'foo', now=105) == (0, 123, 100, None)
+    assert cache.get(b'foo', now=111) is None
+    assert cache.get(b'bar') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_peek():
+    cache = ResultCache(10)
+    cache.set(b'foo', 0, 123, finished=100)
+    assert cache.get(b'foo', now=111) is None
+    # expired results are kept for stale requests
+    assert cache.peek(b'foo') == (0, 123, 100, None)
+    assert cache.peek(b'bar') is None
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_lru():
+    cache = ResultCache(10, max_size=2)
+    cache.set(b'a', 0, 1, finished=100)
+    cache.set(b'b', 0, 2, finished=100)
+    assert cache.get(b'a', now=100)
+    cache.set(b'c', 1, 3, finished=100)
+    assert len(cache) == 2
+    assert cache.get(b'b', now=100) is None
+    assert cache.get(b'a', now=100).pid == 1
+    assert cache.get(b'c', now=100).exit_code == 1
@@ -1,7 +1,10 @@
+import mmap
 import os
 import pwd
+import signal
 import socket
 import sys
+import threading
 import time
 from contextlib import closing
 from contextlib import contextmanager
@@ -17,6 +20,8 @@ from subprocess32 import Popen
 
 from stampede import client
 from stampede.client import TaskFailed
+from stampede.client import TaskTimeout
+from stampede.protocol import TIMEOUT_EXIT_CODE
 
 import helper
 
@@ -41,14 +46,389 @@ def connection(timeout=1):
 def test_prespawned():
     with TestProcess(sys.executable, helper.__file__, 'simple') as proc:
         with dump_on_error(proc.read):
-            wait_for_strings(proc.read, TIMEOUT, 'Queues =>')
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
             response = client.request(helper.PATH, b"foobar")
             assert response.exit_code == 0
             wait_for_strings(proc.read, TIMEOUT,
                              '%s:%s' % (pwd.getpwuid(os.getuid())[0], os.getpid()),
                              'JOB foobar EXECUTED',
-                             'completed. Passing back results to',
-                             'Queues => 0 workspaces')
+                             'completed. Passing back results to')
+            proc.proc.send_signal(signal.SIGUSR1)
+            wait_for_strings(proc.read, TIMEOUT, 'Queues => 0 workspaces')
+
+
+def test_client():
+    with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            with client.Client(helper.PATH) as cli:
+                assert cli.request(b"0").exit_code == 0
+                conn, = cli.idle
+                assert cli.request(b"0.1").exit_code == 0
+                assert cli.idle == [conn]
+                assert cli.request(b"0.1", wait=False) is None
+                pytest.raises(TaskFailed, cli.request, b"foo")
+                assert cli.idle == [conn]
+            assert cli.idle == []
+
+
+def test_client_worker_restart():
+    with client.Client(helper.PATH) as cli:
+        with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+            with dump_on_error(proc.read):
+                wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+                assert cli.request(b"0").exit_code == 0
+                conn, = cli.idle
+        with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+            with dump_on_error(proc.read):
+                wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+                assert cli.request(b"0.1").exit_code == 0
+                assert cli.idle != [conn]
+                assert len(cli.idle) == 1
+
+
+def test_client_pipelining():
+    with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            conn = client.ClientConnection(helper.PATH)
+            try:
+                slow = conn.send(b"0.3")
+                fast = conn.send(b"0.1")
+                assert conn.recv()[0] == fast
+                assert conn.wait(slow).exit_code == 0
+                assert not conn.inflight
+            finally:
+                conn.close()
+
+
+def test_request_many():
+    with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            results = list(client.request_many(helper.PATH, [b"0.4", b"0.2", b"foo", b"0.2"]))
+            keys = [key for key, _ in results]
+            assert keys[0] == b"foo"
+            assert keys[1:] == [b"0.2", b"0.2", b"0.4"]
+            assert isinstance(results[0][1], TaskFailed)
+            assert results[1][1] == results[2][1]
+            assert all(result.exit_code == 0 for _, result in results[1:])
+            assert proc.read().count('JOB 0.2 EXECUTED') == 1
+
+            assert client.request_many(helper.PATH, [b"0"], wait=False) is None
+            wait_for_strings(proc.read, TIMEOUT, 'JOB 0 EXECUTED')
+
+
+@pytest.mark.parametrize('executor', ['ForkExecutor', 'ThreadPoolExecutor', 'ProcessPoolExecutor'])
+def test_payload(executor):
+    with TestProcess(sys.executable, helper.__file__, 'payload', executor) as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            conn = client.ClientConnection(helper.PATH)
+            try:
+                first = conn.send(b"100000", payload=b"ab")
+                second = conn.send(b"100000", payload=b"cd")
+                assert conn.wait(first).result == b"ab" * 100000
+                assert conn.wait(second).result == b"ab" * 100000
+                assert conn.request(b"1", payload=b"\n\r\0").result == b"\n\r\0"
+            finally:
+                conn.close()
+            assert proc.read().count('JOB 100000 EXECUTED') == 1
+
+            response = client.request(helper.PATH, b"2", payload=b"x")
+            assert response.exit_code == 0
+            assert response.result == b"xx"
+            exit_code, _ = response
+
+            with pytest.raises(TaskFailed) as exc_info:
+                client.request(helper.PATH, b"foo", payload=b"x")
+            assert exc_info.value.exit_code == 255
+            assert exc_info.value.result is None
+
+
+@pytest.mark.parametrize('executor', ['ForkExecutor', 'ThreadPoolExecutor'])
+def test_task_timeout(executor):
+    with TestProcess(sys.executable, helper.__file__, 'timeout', executor) as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            for _ in range(2):
+                started = time.time()
+                with pytest.raises(TaskTimeout) as exc_info:
+                    client.request(helper.PATH, b"short")
+                assert time.time() - started < 1
+                assert exc_info.value.exit_code == TIMEOUT_EXIT_CODE
+            # not cached
+            assert client.stats(helper.PATH)["counters"]["tasks_timed_out"] == 2
+            wait_for_strings(proc.read, TIMEOUT, 'timed out after')
+            if executor == 'ForkExecutor':
+                with pytest.raises(TaskFailed) as exc_info:
+                    client.request(helper.PATH, b"alarm")
+                assert type(exc_info.value) is TaskFailed
+                assert exc_info.value.exit_code == signal.SIGALRM
+                time.sleep(2)
+                assert 'timeout FAIL' not in proc.read()
+
+
+def test_submit_fail():
+    with TestProcess(sys.executable, helper.__file__, 'submit_fail') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            with client.Client(helper.PATH, timeout=TIMEOUT) as cli:
+                for _ in range(2):
+                    with pytest.raises(TaskFailed) as exc_info:
+                        cli.request(b"fail")
+                    assert exc_info.value.exit_code == 255
+                assert cli.request(b"ok").exit_code == 0
+                assert cli.stats()["counters"]["tasks_not_started"] == 2
+            wait_for_strings(proc.read, TIMEOUT, 'Failed to start task', 'JOB ok EXECUTED')
+
+
+@pytest.mark.parametrize('executor', ['ForkExecutor', 'ThreadPoolExecutor', 'ProcessPoolExecutor'])
+def test_task_timeout_slot(executor):
+    with TestProcess(sys.executable, helper.__file__, 'slot', executor) as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            conn = client.ClientConnection(helper.PATH, TIMEOUT)
+            try:
+                slow = conn.send(b"short:1")
+                fast = dict((conn.send(key), key) for key in [b"short:0.01:a", b"short:0.01:b", b"short:0.01:c"])
+                with pytest.raises(TaskTimeout):
+                    conn.wait(slow)
+                for key, result in conn.iter_results(fast):
+                    assert result.exit_code == 0, key
+            finally:
+                conn.close()
+            output = proc.read()
+            for key in 'abc':
+                assert output.count('JOB short:0.01:%s EXECUTED' % key) == 1
+            if executor == 'ForkExecutor':
+                assert 'JOB short:1 EXECUTED' not in output
+            else:
+                # the call can't be stopped so the next task only started after it
+                assert output.index('JOB short:1 EXECUTED') < output.index('JOB short:0.01')
+            assert client.stats(helper.PATH)["counters"]["tasks_timed_out"] == 1
+
+
+def test_stale():
+    with TestProcess(sys.executable, helper.__file__, 'stale') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            first = client.request(helper.PATH, b"foo", stale=True)
+            assert first.stale is None
+            time.sleep(0.6)
+
+            started = time.time()
+            stale = client.request(helper.PATH, b"foo", stale=True, shared=PY3)
+            assert time.time() - started < 0.2
+            assert stale.result[:] == first.result
+            assert stale.stale > 0.5
+
+            fresh = client.request(helper.PATH, b"foo")
+            assert fresh.result != first.result
+            assert fresh.stale is None
+            assert client.request(helper.PATH, b"foo", stale=True).result == fresh.result
+            assert proc.read().count('JOB foo EXECUTED') == 2
+            stats = client.stats(helper.PATH)
+            assert stats["counters"]["stale_responses"] == 1
+            assert stats["counters"]["collapsed_requests"] == 1
+
+
+def test_coalesce():
+    with TestProcess(sys.executable, helper.__file__, 'coalesce') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            results = []
+
+            def request():
+                results.append(client.request(helper.PATH, b"foo"))
+
+            started = time.time()
+            threads = [threading.Thread(target=request) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+                time.sleep(0.1)
+            for thread in threads:
+                thread.join()
+            assert time.time() - started > 0.3
+            assert len(set(result.result for result in results)) == 1
+            assert proc.read().count('JOB foo EXECUTED') == 1
+
+            started = time.time()
+            client.request(helper.PATH, b"now")
+            assert time.time() - started < 0.3
+            stats = client.stats(helper.PATH)
+            assert stats["counters"]["held_tasks"] == 1
+            assert stats["counters"]["collapsed_requests"] == 2
+            assert stats["counters"]["saved_runs"] == 2
+
+
+@pytest.fixture
+def legacy_worker(tmpdir):
+    path = str(tmpdir.join('legacy'))
+    worker = helper.LegacyWorker(path)
+    worker.start()
+    yield path, worker
+    worker.close()
+    worker.join()
+
+
+def test_legacy_worker(legacy_worker):
+    path, worker = legacy_worker
+    result = client.request(path, b"foo")
+    assert result == (0, 123)
+    assert result.result is None
+    with pytest.raises(TaskFailed):
+        client.request(path, b"fail")
+    assert client.request(path, b"bar", wait=False) is None
+    with closing(client.Client(path)) as pooled:
+        assert pooled.request(b"baz") == (0, 123)
+    with pytest.raises(client.LegacyWorker):
+        client.request(path, b"foo", payload=b"x")
+    while len(worker.keys) < 4:
+        time.sleep(0.01)
+    assert worker.keys == [b"foo", b"fail", b"bar", b"baz"]
+
+
+def test_singleflight_call():
+    flights = client.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def func(value):
+        calls.append(value)
+        started.set()
+        release.wait()
+        if value == "fail":
+            raise TaskFailed(1, 123)
+        return [value]
+
+    def call(value):
+        try:
+            results.append(flights.call(value, func, value))
+        except TaskFailed as exc:
+            results.append(exc)
+
+    for value in ["ok", "fail"]:
+        started.clear()
+        release.clear()
+        threads = [threading.Thread(target=call, args=(value,)) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while flights.flights[value].followers < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+    assert calls == ["ok", "fail"]
+    assert len(results) == 10
+    assert all(result is results[0] for result in results[:5])
+    assert all(result is results[5] for result in results[5:])
+    assert isinstance(results[5], TaskFailed)
+    assert not flights.flights
+
+    assert flights.call("ok", func, "again") == ["again"]
+
+
+@pytest.mark.parametrize('singleflight', ['request', 'Client'])
+def test_singleflight(singleflight):
+    with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            pooled = client.Client(helper.PATH, singleflight=True)
+            if singleflight == 'request':
+                def request():
+                    results.append(client.request(helper.PATH, b"0.3", singleflight=True))
+            else:
+                def request():
+                    results.append(pooled.request(b"0.3"))
+            results = []
+            before = client.stats(helper.PATH)["counters"]
+            threads = [threading.Thread(target=request) for _ in range(16)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            pooled.close()
+            assert len(results) == 16
+            assert all(result is results[0] for result in results)
+            after = client.stats(helper.PATH)["counters"]
+            assert after["requests"] - before["requests"] == 1
+            assert after["tasks_started"] - before["tasks_started"] == 1
+
+
+@pytest.mark.parametrize('entrypoint', ['shared', 'payload'])
+def test_shared_result(entrypoint):
+    with TestProcess(sys.executable, helper.__file__, entrypoint) as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            first = client.ClientConnection(helper.PATH)
+            second = client.ClientConnection(helper.PATH)
+            try:
+                first_id = first.send(b"100000", payload=b"ab", shared=True)
+                second_id = second.send(b"100000", payload=b"ab", shared=True)
+                plain_id = second.send(b"100000", payload=b"ab")
+                first_result = first.wait(first_id).result
+                second_result = second.wait(second_id).result
+                assert isinstance(first_result, mmap.mmap)
+                assert isinstance(second_result, mmap.mmap)
+                assert first_result[:] == second_result[:] == b"ab" * 100000
+                assert second.wait(plain_id).result == b"ab" * 100000
+                assert not first.fds and not second.fds
+
+                assert first.request(b"0", payload=b"ab", shared=True).result is None
+            finally:
+                first.close()
+                second.close()
+            assert proc.read().count('JOB 100000 EXECUTED') == 1
+
+            result = client.request(helper.PATH, b"3", payload=b"x", shared=True).result
+            assert result.read() == b"xxx"
+
+
+def test_stats():
+    with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            results = list(client.request_many(helper.PATH, [b"0.1", b"0.2", b"0.1", b"foo"]))
+            assert len(results) == 4
+            stats = client.stats(helper.PATH)
+            assert stats["counters"]["accepts"] == 2
+            assert stats["counters"]["requests"] == 4
+            assert stats["counters"]["collapsed_requests"] == 1
+            assert stats["counters"]["tasks_started"] == stats["counters"]["tasks_completed"] == 3
+            assert stats["counters"]["tasks_failed"] == 1
+            assert stats["counters"]["responses"] == 4
+            assert stats["gauges"]["workspaces"] == 0
+            task_clients = stats["histograms"]["task_clients"]
+            assert task_clients["count"] == 3
+            assert task_clients["sum"] == 4
+            assert stats["histograms"]["task_seconds"]["sum"] >= 0.3
+
+            with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as idle:
+                idle.settimeout(TIMEOUT)
+                idle.connect(helper.METRICS_PATH)
+                started = time.time()
+                assert idle.recv(100) == b""
+                assert 0.5 < time.time() - started < 2  # request_timeout is 1s
+            wait_for_strings(proc.read, TIMEOUT, "Failed to read request from client metrics: timed out")
+
+            with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+                sock.settimeout(TIMEOUT)
+                sock.connect(helper.METRICS_PATH)
+                sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+                response = b""
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    response += data
+            assert response.startswith(b"HTTP/1.0 200 OK\r\n")
+            assert b"\nstampede_requests_total 4\n" in response
+            assert b'\nstampede_task_clients_bucket{le="2"} 3\n' in response
 
 
 def test_bad_request():
@@ -118,6 +498,37 @@ def request_and_spawn(request, setup_request_and_spawn):
     yield request_and_spawn_wrapper
 
 
+def test_request_and_spawn_concurrent(monkeypatch):
+    if os.path.exists(UDS_PATH):
+        os.unlink(UDS_PATH)
+    spawned = []
+
+    def popen(*args, **kwargs):
+        spawned.append(Popen(*args, **kwargs))
+        return spawned[-1]
+
+    monkeypatch.setattr(client, 'Popen', popen)
+    results = []
+
+    def run(key):
+        results.append(client.request_and_spawn([sys.executable, helper.__file__, 'simple'], helper.PATH, key,
+                                                timeout=TIMEOUT))
+
+    threads = [threading.Thread(target=run, args=(b"foobar%d" % i,)) for i in range(5)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(TIMEOUT)
+        assert len(spawned) == 1
+        assert len(results) == 5
+        assert [result.exit_code for result in results] == [0] * 5
+    finally:
+        for child in psutil.Process(os.getpid()).children(recursive=True):
+            child.kill()
+            child.wait()
+
+
 def get_children():
     return [
         proc
@@ -135,7 +546,6 @@ def test_request_and_spawn(capfd, request_and_spawn):
     if request_and_spawn.kind != 'running':
         assert '%s:%s' % (pwd.getpwuid(os.getuid())[0], os.getpid()) in captured.err
         assert 'completed. Passing back results to' in captured.err
-        assert 'Queues => 0 workspaces' in captured.err
 
     request_and_spawn(wait=False)
     request_and_spawn(wait=False)
@@ -159,4 +569,3 @@ def test_request_and_spawn(capfd, request_and_spawn):
     if request_and_spawn.kind != 'running':
         assert '%s:%s' % (pwd.getpwuid(os.getuid())[0], os.getpid()) in captured.err
         assert 'completed. Passing back results to' in captured.err
-        assert 'Queues => 0 workspaces' in captured.err
@@ -0,0 +1,27 @@
+from stampede.metrics import Histogram
+from stampede.metrics import Metrics
+
+
+def test_histogram():
+    histogram = Histogram((1, 10))
+    for value in 0.5, 1, 5, 100:
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.sum == 106.5
+    assert list(histogram.cumulative()) == [(1, 2), (10, 3), ("+Inf", 4)]
+
+
+def test_prometheus():
+    metrics = Metrics(lambda: {"running_tasks": 2})
+    metrics.incr("requests", 3)
+    metrics.observe("task_clients", 2)
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["requests"] == 3
+    assert snapshot["gauges"]["running_tasks"] == 2
+    assert snapshot["histograms"]["task_clients"]["count"] == 1
+    text = metrics.format_prometheus()
+    assert "# TYPE stampede_requests_total counter\nstampede_requests_total 3\n" in text
+    assert "stampede_running_tasks 2\n" in text
+    assert 'stampede_task_clients_bucket{le="1"} 0\nstampede_task_clients_bucket{le="2"} 1\n' in text
+    assert 'stampede_task_clients_bucket{le="+Inf"} 1\n' in text
+    assert text.endswith("stampede_task_seconds_count 0\n")
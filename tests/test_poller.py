@@ -0,0 +1,47 @@
+import os
+import select
+import socket
+from contextlib import closing
+
+import pytest
+
+from stampede.poller import READ
+from stampede.poller import WRITE
+from stampede.poller import EpollPoller
+from stampede.poller import SelectPoller
+
+POLLERS = [SelectPoller]
+if hasattr(select, 'epoll'):
+    POLLERS.append(EpollPoller)
+
+
+@pytest.fixture(params=POLLERS, ids=lambda cls: cls.__name__)
+def poller(request):
+    poller = request.param()
+    yield poller
+    poller.close()
+
+
+def test_read_write(poller):
+    a, b = socket.socketpair()
+    with closing(a), closing(b):
+        poller.register(a, READ)
+        assert poller.poll(0) == []
+        b.sendall(b'x')
+        assert poller.poll(1) == [(a, READ)]
+        poller.modify(a, READ | WRITE)
+        assert poller.poll(1) == [(a, READ | WRITE)]
+        poller.unregister(a)
+        assert poller.poll(0) == []
+
+
+def test_int_fds(poller):
+    r, w = os.pipe()
+    try:
+        poller.register(r, READ)
+        os.write(w, b'x')
+        assert poller.poll(1) == [(r, READ)]
+        poller.unregister(r)
+    finally:
+        os.close(r)
+        os.close(w)
@@ -0,0 +1,48 @@
+import array
+import fcntl
+import os
+import socket
+from contextlib import closing
+
+import pytest
+
+from stampede.connection import Connection
+from stampede.shared import SharedResult
+from stampede.shared import create_memfd
+
+
+def test_from_bytes():
+    result = SharedResult.from_bytes(b"foobar")
+    assert len(result) == 6
+    assert result.read() == b"foobar"
+    if hasattr(fcntl, "F_ADD_SEALS") and hasattr(os, "memfd_create"):
+        pytest.raises(OSError, os.write, result.fileno(), b"x")
+
+
+def test_empty():
+    assert SharedResult.from_fd(create_memfd()) is None
+
+
+def test_send_files():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with closing(a), closing(b):
+        result = SharedResult.from_bytes(b"foobar")
+        conn = Connection(a, "test")
+        conn.write(b"first\n")
+        conn.write(b"second\n", [result])
+        conn.write(b"third\n")
+        assert conn.flush()
+        assert not conn.wfds
+        data = b""
+        fds = array.array("i")
+        while len(data) < 19:
+            chunk, ancillary, _, _ = b.recvmsg(1024, socket.CMSG_SPACE(4))
+            data += chunk
+            for _, _, fd_data in ancillary:
+                fds.frombytes(fd_data)
+        assert data == b"first\nsecond\nthird\n"
+        assert len(fds) == 1
+        try:
+            assert os.fstat(fds[0]).st_ino == os.fstat(result.fileno()).st_ino
+        finally:
+            os.close(fds[0])
@@ -0,0 +1,119 @@
+import os
+import time
+
+from stampede.cache import Result
+from stampede.cache import ResultCache
+from stampede.shared import SharedResult
+from stampede.store import ResultStore
+
+
+def test_persistent(tmpdir):
+    path = str(tmpdir.join("results"))
+    store = ResultStore(path)
+    store.set(b"foo", Result(0, 123, 100, b"foobar"))
+    store.set(b"bar", Result(1, 124, 100, None))
+    store.set(b"foo", Result(0, 125, 101, SharedResult.from_bytes(b"second")))
+    assert store.get(b"foo") == (0, 125, 101, b"second")
+    store.close()
+
+    store = ResultStore(path)
+    assert len(store) == 2
+    assert store.get(b"foo") == (0, 125, 101, b"second")
+    assert store.get(b"bar") == (1, 124, 100, None)
+    assert store.get(b"baz") is None
+    store.close()
+
+
+def test_recover(tmpdir):
+    path = str(tmpdir.join("results"))
+    store = ResultStore(path)
+    store.set(b"foo", Result(0, 123, 100, b"foobar"))
+    store.close()
+    size = os.path.getsize(path + ".log")
+    with open(path + ".log", "ab") as fh:
+        # a record torn by a crash (and an index that doesn't know about it)
+        fh.write(b"\x01\x02\x03")
+
+    store = ResultStore(path)
+    assert store.get(b"foo") == (0, 123, 100, b"foobar")
+    assert os.path.getsize(path + ".log") == size
+    store.set(b"bar", Result(0, 124, 100, None))
+    store.close()
+
+    os.unlink(path + ".idx")
+    store = ResultStore(path)
+    assert len(store) == 2
+    assert store.get(b"bar") == (0, 124, 100, None)
+    store.close()
+
+
+def test_resize(tmpdir):
+    store = ResultStore(str(tmpdir.join("results")))
+    for i in range(3000):
+        store.set(b"key%d" % i, Result(0, i, 100, None))
+    assert store.capacity == 8192
+    assert len(store) == 3000
+    assert all(store.get(b"key%d" % i).pid == i for i in range(3000))
+    store.close()
+
+
+def test_compact(tmpdir):
+    path = str(tmpdir.join("results"))
+    store = ResultStore(path)
+    store.compact_min_size = 1000
+    now = time.time()
+    store.set(b"old", Result(0, 1, now - 5, None))
+    for i in range(100):
+        store.set(b"foo", Result(0, i, now, b"x" * 100))
+    # compacting is left to the worker loop
+    assert store.log_size > 10000
+    assert store.should_compact()
+    store.compact()
+    assert store.log_size < 1000
+    assert len(store) == 2
+    assert store.get(b"foo").pid == 99
+    # expired results are kept, they can still be served stale
+    assert store.get(b"old") == (0, 1, now - 5, None)
+    store.close()
+
+    store = ResultStore(path)
+    assert store.get(b"foo") == (0, 99, now, b"x" * 100)
+    store.close()
+
+
+def test_should_compact(tmpdir):
+    store = ResultStore(str(tmpdir.join("results")))
+    store.compact_min_size = 1000
+    for i in range(20):
+        # distinct keys, nothing is overwritten
+        store.set(b"key%d" % i, Result(0, i, 100, b"x" * 100))
+    assert not store.should_compact(idle=True)
+    for i in range(20):
+        store.set(b"key%d" % i, Result(0, i, 200, b"x" * 100))
+    # half of it is overwritten records
+    assert store.should_compact(idle=True)
+    assert not store.should_compact(idle=False)
+    for i in range(20):
+        store.set(b"key%d" % i, Result(0, i, 300, b"x" * 100))
+        store.set(b"key%d" % i, Result(0, i, 400, b"x" * 100))
+    assert store.should_compact(idle=False)
+    store.compact()
+    assert not store.should_compact(idle=True)
+    assert len(store) == 20
+    assert all(store.get(b"key%d" % i).finished == 400 for i in range(20))
+    store.close()
+
+
+def test_cache(tmpdir):
+    path = str(tmpdir.join("results"))
+    cache = ResultCache(10, max_size=1, store=ResultStore(path))
+    cache.set(b"foo", 0, 123, b"foobar", finished=100)
+    cache.set(b"bar", 0, 124, finished=100)
+    assert len(cache) == 1
+    assert cache.get(b"foo", now=105) == (0, 123, 100, b"foobar")
+    assert cache.get(b"foo", now=111) is None
+    cache.close()
+
+    cache = ResultCache(10, store=ResultStore(path))
+    assert cache.get(b"bar", now=105).pid == 124
+    cache.close()
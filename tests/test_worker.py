@@ -1,12 +1,15 @@
 import json
 import os
 import pwd
+import select
+import signal
 import socket
 import sys
 import time
 from contextlib import closing
 from contextlib import contextmanager
 
+import psutil
 import pytest
 from process_tests import TestProcess
 from process_tests import dump_on_error
@@ -35,7 +38,7 @@ def connection(timeout=1):
 def test_simple():
     with TestProcess(sys.executable, helper.__file__, 'simple') as proc:
         with dump_on_error(proc.read):
-            wait_for_strings(proc.read, TIMEOUT, 'Queues =>')
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
             with connection() as fh:
                 fh.write(b"first")
                 fh.write(b"-second\n")
@@ -44,14 +47,15 @@ def test_simple():
                 wait_for_strings(proc.read, TIMEOUT,
                                  '%s:%s' % (pwd.getpwuid(os.getuid())[0], os.getpid()),
                                  'JOB first-second EXECUTED',
-                                 'completed. Passing back results to',
-                                 'Queues => 0 workspaces')
+                                 'completed. Passing back results to')
+                proc.proc.send_signal(signal.SIGUSR1)
+                wait_for_strings(proc.read, TIMEOUT, 'Queues => 0 workspaces')
 
 
 def test_fail():
     with TestProcess(sys.executable, helper.__file__, 'fail') as proc:
         with dump_on_error(proc.read):
-            wait_for_strings(proc.read, TIMEOUT, 'Queues =>')
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
             with connection() as fh:
                 fh.write(b"first")
                 fh.write(b"-second\n")
@@ -60,14 +64,15 @@ def test_fail():
                 wait_for_strings(proc.read, TIMEOUT,
                                  '%s:%s' % (pwd.getpwuid(os.getuid())[0], os.getpid()),
                                  'Failed task',
-                                 'Exception: FAIL',
-                                 'Queues => 0 workspaces')
+                                 'Exception: FAIL')
+                proc.proc.send_signal(signal.SIGUSR1)
+                wait_for_strings(proc.read, TIMEOUT, 'Queues => 0 workspaces')
 
 
 def test_incomplete_request():
     with TestProcess(sys.executable, helper.__file__, 'simple') as proc:
         with dump_on_error(proc.read):
-            wait_for_strings(proc.read, TIMEOUT, 'Queues =>')
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
             with connection(2) as fh:
                 fh.write(b"first")
                 line = fh.readline()
@@ -77,10 +82,30 @@ def test_incomplete_request():
                                      pwd.getpwuid(os.getuid())[0], os.getpid()))
 
 
+def test_slow_client():
+    with TestProcess(sys.executable, helper.__file__, 'simple') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            with connection(2) as slow:
+                slow.write(b"fir")
+                t1 = time.time()
+                with connection() as fh:
+                    fh.write(b"second\n")
+                    line = fh.readline()
+                    assert b'"exit_code": 0' in line
+                assert time.time() - t1 < 0.5
+                slow.write(b"st\n")
+                line = slow.readline()
+                assert b'"exit_code": 0' in line
+                wait_for_strings(proc.read, TIMEOUT,
+                                 'JOB second EXECUTED',
+                                 'JOB first EXECUTED')
+
+
 def test_queue_collapse():
     with TestProcess(sys.executable, helper.__file__, 'queue_collapse') as proc:
         with dump_on_error(proc.read):
-            wait_for_strings(proc.read, TIMEOUT, 'Queues =>')
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
             clients = []
             for _ in range(5):
                 sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -106,14 +131,62 @@ def test_queue_collapse():
                 [(fh.close(), sock.close()) for fh, sock in clients]
 
 
+def test_max_tasks():
+    with TestProcess(sys.executable, helper.__file__, 'max_tasks') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            clients = []
+            for key in [b"first", b"second", b"third", b"urgent"]:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(TIMEOUT)
+                sock.connect(UDS_PATH)
+                sock.sendall(key + b"\n")
+                clients.append(sock)
+                wait_for_strings(proc.read, TIMEOUT, 'Got request %r' % key)
+            try:
+                for sock in clients:
+                    assert b'"exit_code": 0' in sock.recv(1024)
+                wait_for_strings(proc.read, TIMEOUT,
+                                 'JOB first STARTED',
+                                 '3 pending',
+                                 'JOB urgent STARTED',
+                                 'JOB second STARTED',
+                                 'JOB third STARTED',
+                                 '(0 running, 0 pending)')
+                output = proc.read()
+                assert '2 running' not in output
+            finally:
+                [sock.close() for sock in clients]
+
+
+def test_cached():
+    with TestProcess(sys.executable, helper.__file__, 'cached') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            responses = []
+            for _ in range(3):
+                with connection() as fh:
+                    fh.write(b"foobar\n")
+                    responses.append(json.loads(fh.readline().decode('ascii')))
+            assert responses[0]["exit_code"] == 0
+            assert responses[0] == responses[1] == responses[2]
+            wait_for_strings(proc.read, TIMEOUT,
+                             'JOB foobar EXECUTED',
+                             'Passing back cached result',
+                             'Passing back cached result')
+            proc.proc.send_signal(signal.SIGUSR1)
+            wait_for_strings(proc.read, TIMEOUT, 'Results => ResultCache(1 entries, hits=2, misses=1)')
+            assert proc.read().count('JOB foobar EXECUTED') == 1
+
+
 def test_timeout():
     with TestProcess(sys.executable, helper.__file__, 'timeout') as proc:
         with dump_on_error(proc.read):
-            wait_for_strings(proc.read, TIMEOUT, 'Queues =>')
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
             with connection(3) as fh:
                 fh.write(b"foobar\n")
                 line = fh.readline()
-                json.loads(line.decode('ascii'))["exit_code"] == 14
+                assert json.loads(line.decode('ascii'))["exit_code"] == 14
                 wait_for_strings(proc.read, TIMEOUT,
                                  '%s:%s' % (pwd.getpwuid(os.getuid())[0], os.getpid()),
                                  'timeout STARTED',
@@ -124,17 +197,29 @@ def test_timeout():
 def test_custom_exit_code():
     with TestProcess(sys.executable, helper.__file__, 'custom_exit_code') as proc:
         with dump_on_error(proc.read):
-            wait_for_strings(proc.read, TIMEOUT, 'Queues =>')
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
             with connection(3) as fh:
                 fh.write(b"asdf\n")
                 line = fh.readline()
                 json.loads(line.decode('ascii'))["exit_code"] == 123
 
 
+def test_preload():
+    with TestProcess(sys.executable, helper.__file__, 'preload') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            assert proc.read().index('PRELOADING') < proc.read().index('Preloaded in')
+            with connection() as fh:
+                fh.write(b"first\n")
+                line = fh.readline()
+                assert b'"exit_code": 0' in line
+                wait_for_strings(proc.read, TIMEOUT, 'forked in', 'JOB first PRELOADED')
+
+
 def test_bad_client():
     with TestProcess(sys.executable, helper.__file__, 'simple') as proc:
         with dump_on_error(proc.read):
-            wait_for_strings(proc.read, TIMEOUT, 'Queues =>')
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
             sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             sock.settimeout(1)
             sock.connect(UDS_PATH)
@@ -158,7 +243,7 @@ def test_bad_client():
 def test_empty_request():
     with TestProcess(sys.executable, helper.__file__, 'simple') as proc:
         with dump_on_error(proc.read):
-            wait_for_strings(proc.read, TIMEOUT, 'Queues =>')
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
             sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             sock.settimeout(1)
             sock.connect(UDS_PATH)
@@ -176,6 +261,327 @@ def test_empty_request():
                              'Got empty request from client %s:%s' % (pwd.getpwuid(os.getuid())[0], os.getpid()))
 
 
+def test_protocol_v2():
+    with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            with connection(TIMEOUT) as fh:
+                fh.write(b"\rSTAMPEDE/2\n")
+                fh.write(b'{"id": 1, "key": "0.3"}\n{"id": 2, "key": "0.1"}\n{"id": 3, "key": "0.3"}\n')
+                assert json.loads(fh.readline().decode('ascii')) == {"version": 2}
+                first = json.loads(fh.readline().decode('ascii'))
+                assert first["id"] == 2
+                assert first["exit_code"] == 0
+                second, third = sorted([json.loads(fh.readline().decode('ascii')),
+                                        json.loads(fh.readline().decode('ascii'))], key=lambda item: item["id"])
+                assert (second["id"], third["id"]) == (1, 3)
+                assert second["pid"] == third["pid"] != first["pid"]
+
+                fh.write(b'{"id": 4, "key": "0"}\n')
+                assert json.loads(fh.readline().decode('ascii'))["id"] == 4
+
+                fh.write(b'garbage\n')
+                assert fh.readline() == b''
+                wait_for_strings(proc.read, TIMEOUT, 'Failed to read request from client')
+
+
+@pytest.mark.parametrize('executor', ['ThreadPoolExecutor', 'ProcessPoolExecutor'])
+def test_pool_executor(executor):
+    with TestProcess(sys.executable, helper.__file__, 'sleep', executor) as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            with connection(TIMEOUT) as fh:
+                fh.write(b"\rSTAMPEDE/2\n")
+                fh.write(b'{"id": 1, "key": "0.3"}\n{"id": 2, "key": "0.1"}\n{"id": 3, "key": "0.3"}\n'
+                         b'{"id": 4, "key": "foo"}\n')
+                assert json.loads(fh.readline().decode('ascii')) == {"version": 2}
+                responses = {}
+                for _ in range(4):
+                    response = json.loads(fh.readline().decode('ascii'))
+                    responses[response.pop("id")] = response
+                assert responses[1] == responses[3]
+                assert responses[1]["exit_code"] == responses[2]["exit_code"] == 0
+                assert responses[4]["exit_code"] == 255
+                if executor == 'ThreadPoolExecutor':
+                    assert responses[1]["pid"] == responses[2]["pid"] == proc.proc.pid
+                else:
+                    assert responses[1]["pid"] != proc.proc.pid
+                wait_for_strings(proc.read, TIMEOUT, 'JOB 0.1 EXECUTED')
+                wait_for_strings(proc.read, TIMEOUT, 'JOB 0.3 EXECUTED')
+                assert proc.read().count('JOB 0.3 EXECUTED') == 1
+
+
+def activate_socket(sock):
+    def preexec():
+        os.dup2(sock.fileno(), 3)
+        os.environ['LISTEN_FDS'] = '1'
+        os.environ['LISTEN_PID'] = str(os.getpid())
+    return preexec
+
+
+def test_pool_executor_start():
+    from stampede.executors import ThreadPoolExecutor
+
+    class Worker(object):
+        max_tasks = 1
+        started = []
+
+        def execute_task(self, key, payload):
+            time.sleep(float(key))
+            return 0, None
+
+        def task_started(self, task_id, started_at):
+            self.started.append(task_id)
+
+    worker = Worker()
+    executor = ThreadPoolExecutor(worker)
+    executor.start()
+    try:
+        first = executor.submit(b"0.2")
+        second = executor.submit(b"0")
+        third = executor.submit(b"0")
+        executor.cancel(third)  # still waiting in the pool's queue
+        completed = []
+        while len(completed) < 2:
+            select.select([executor.fd], [], [], TIMEOUT)
+            completed.extend(task_id for task_id, _, _, _ in executor.collect())
+        time.sleep(0.1)
+        assert list(executor.collect()) == []
+        assert completed == worker.started == [first, second]
+        assert not executor.cancelled and not executor.futures
+    finally:
+        executor.shutdown()
+
+
+def test_socket_activation():
+    if os.path.exists(UDS_PATH):
+        os.unlink(UDS_PATH)
+    with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+        sock.bind(UDS_PATH)
+        sock.listen(16)
+        with connection(TIMEOUT) as early:
+            # the worker is not even started but connecting works (the client waits in the backlog)
+            early.write(b"early\n")
+            with TestProcess(sys.executable, helper.__file__, 'simple',
+                             env=None, preexec_fn=activate_socket(sock), pass_fds=[3]) as proc:
+                with dump_on_error(proc.read):
+                    wait_for_strings(proc.read, TIMEOUT, 'Using inherited socket', 'Ready to accept requests')
+                    assert b'"exit_code": 0' in early.readline()
+                    wait_for_strings(proc.read, TIMEOUT, 'JOB early EXECUTED')
+                    assert 'Binding to' not in proc.read()
+        with connection(TIMEOUT) as fh:
+            # and the same between restarts
+            fh.write(b"restarted\n")
+            with TestProcess(sys.executable, helper.__file__, 'simple',
+                             env=None, preexec_fn=activate_socket(sock), pass_fds=[3]) as proc:
+                with dump_on_error(proc.read):
+                    assert b'"exit_code": 0' in fh.readline()
+                    wait_for_strings(proc.read, TIMEOUT, 'JOB restarted EXECUTED')
+    os.unlink(UDS_PATH)
+
+
+@pytest.mark.parametrize('executor', ['ForkExecutor', 'ThreadPoolExecutor'])
+def test_handoff(executor):
+    from stampede import client
+
+    with TestProcess(sys.executable, helper.__file__, 'sleep', executor) as old:
+        with dump_on_error(old.read):
+            wait_for_strings(old.read, TIMEOUT, 'Ready to accept requests')
+            conn = client.ClientConnection(helper.PATH, TIMEOUT)
+            try:
+                running = conn.send(b"0.7")
+                wait_for_strings(old.read, TIMEOUT, 'Started task')
+                with TestProcess(sys.executable, helper.__file__, 'sleep', executor, 'handoff') as new:
+                    with dump_on_error(new.read):
+                        wait_for_strings(new.read, TIMEOUT,
+                                         'Took over 1 connections and 1 workspaces (1 tasks still running',
+                                         'Ready to accept requests')
+                        wait_for_strings(old.read, TIMEOUT, 'Handed off 1 connections')
+                        # joins the task that is still running in the old worker
+                        collapsed = client.request(helper.PATH, b"0.7")
+                        assert conn.wait(running) == collapsed
+                        assert collapsed.exit_code == 0
+                        # and the old connection is served by the new worker
+                        assert conn.request(b"0.1").exit_code == 0
+                        wait_for_strings(old.read, TIMEOUT, 'JOB 0.7 EXECUTED', 'All the tasks running at handoff completed')
+                        assert old.proc.wait(TIMEOUT) == 0
+                        wait_for_strings(new.read, TIMEOUT, 'Handoff completed')
+                        wait_for_strings(new.read, TIMEOUT, 'JOB 0.1 EXECUTED')
+                        assert 'JOB 0.7 EXECUTED' not in new.read()
+                        assert client.is_running(helper.PATH, UDS_PATH)
+                        stats = client.stats(helper.PATH)
+                        assert stats["counters"]["collapsed_requests"] == 1
+                        assert stats["counters"]["tasks_completed"] == 2
+            finally:
+                conn.close()
+
+
+def test_accept_burst():
+    from stampede import client
+    from stampede.protocol import HANDSHAKE
+
+    with TestProcess(sys.executable, helper.__file__, 'simple') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            socks = []
+            try:
+                for _ in range(500):
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    socks.append(sock)
+                    sock.setblocking(False)
+                    # fails with EAGAIN if the backlog is full
+                    sock.connect(UDS_PATH)
+                    sock.send(HANDSHAKE + b"\n")
+                for sock in socks:
+                    sock.settimeout(TIMEOUT)
+                    assert sock.recv(100) == b'{"version":2}\n'
+                assert client.stats(helper.PATH)["counters"]["accepts"] == 501
+            finally:
+                for sock in socks:
+                    sock.close()
+
+
+def test_sharded_accept_burst():
+    from stampede.protocol import HANDSHAKE
+    from stampede.protocol import encode_stats_request
+
+    with TestProcess(sys.executable, helper.__file__, 'sharded') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Started 4 shards')
+            while proc.read().count('Ready to accept requests') < 4:
+                time.sleep(0.05)
+            shard_procs = psutil.Process(proc.proc.pid).children()
+            socks = []
+            try:
+                # the burst is waiting in the backlog when the shards wake up
+                for shard_proc in shard_procs:
+                    shard_proc.suspend()
+                for _ in range(200):
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    socks.append(sock)
+                    sock.connect(UDS_PATH)
+                    sock.sendall(HANDSHAKE + b"\n" + encode_stats_request(1))
+                for shard_proc in shard_procs:
+                    shard_proc.resume()
+                shards = set()
+                for sock in socks:
+                    sock.settimeout(TIMEOUT)
+                    with closing(sock.makefile('rb')) as fh:
+                        assert fh.readline() == b'{"version":2}\n'
+                        stats = json.loads(fh.readline().decode('ascii'))["stats"]
+                    shards.add(stats["gauges"]["shard"])
+                # a single shard doesn't take the whole burst
+                assert len(shards) > 1
+            finally:
+                for shard_proc in shard_procs:
+                    shard_proc.resume()
+                for sock in socks:
+                    sock.close()
+
+
+def test_sharded():
+    from stampede.client import ClientConnection
+
+    keys = [('key%s' % i).encode('ascii') for i in range(20)]
+    with TestProcess(sys.executable, helper.__file__, 'sharded') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Started 4 shards', 'Ready to accept requests')
+            conns = [ClientConnection(helper.PATH, TIMEOUT) for _ in range(8)]
+            try:
+                requests = []
+                for i, conn in enumerate(conns):
+                    requests.append((conn, dict((conn.send(key, shared=PY3 and i % 2), key) for key in keys)))
+                for conn, sent in requests:
+                    for key, result in conn.iter_results(sent):
+                        assert result.exit_code == 0
+                        assert result.result[:] == key * 2
+                stats = conns[0].stats()
+                assert stats["gauges"]["shard"] in range(4)
+            finally:
+                for conn in conns:
+                    conn.close()
+            # all the tasks completed so they logged already
+            output = proc.read()
+            for i in range(20):
+                assert output.count('JOB key%s EXECUTED' % i) == 1
+            assert 'Forwarded Workspace' in output
+
+
+def test_sharded_supervisor():
+    from stampede import client
+
+    with TestProcess(sys.executable, helper.__file__, 'sharded') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Started 4 shards')
+            while proc.read().count('Ready to accept requests') < 4:
+                time.sleep(0.05)
+            shards = psutil.Process(proc.proc.pid).children()
+            assert len(shards) == 4
+
+            proc.proc.send_signal(signal.SIGUSR1)
+            t = time.time()
+            while proc.read().count('Queues => 0 workspaces') < 4:
+                assert time.time() - t < TIMEOUT
+                time.sleep(0.05)
+            assert proc.is_alive
+            assert client.is_running(helper.PATH, UDS_PATH)
+
+            proc.proc.kill()
+            gone, alive = psutil.wait_procs(shards, timeout=TIMEOUT)
+            assert not alive
+            assert proc.read().count('Supervisor exited, stopping shard') == 4
+
+
+def test_result_store():
+    from stampede import client
+
+    for suffix in '.log', '.idx':
+        if os.path.exists(helper.RESULTS_PATH + suffix):
+            os.unlink(helper.RESULTS_PATH + suffix)
+    for restart in range(2):
+        with TestProcess(sys.executable, helper.__file__, 'stored') as proc:
+            with dump_on_error(proc.read):
+                wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+                assert client.request(helper.PATH, b'foo').result == b'foofoo'
+                if restart:
+                    wait_for_strings(proc.read, TIMEOUT, 'Passing back cached result')
+                    assert 'JOB foo EXECUTED' not in proc.read()
+                else:
+                    wait_for_strings(proc.read, TIMEOUT, 'JOB foo EXECUTED')
+
+
+def test_task_signal():
+    from stampede import client
+    with TestProcess(sys.executable, helper.__file__, 'signal') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            assert client.request(helper.PATH, b"foo").exit_code == 0
+            wait_for_strings(proc.read, TIMEOUT, 'JOB foo GOT SIGUSR1')
+
+
+def test_handoff_argument():
+    from stampede import StampedeWorker
+    from stampede.worker import StampedeStub
+
+    class MyWorker(StampedeWorker):
+        def __init__(self, path, config, *args, **kwargs):
+            super(MyWorker, self).__init__(path, *args, **kwargs)
+            self.config = config
+
+    with TestProcess(sys.executable, helper.__file__, 'sleep') as proc:
+        with dump_on_error(proc.read):
+            wait_for_strings(proc.read, TIMEOUT, 'Ready to accept requests')
+            MyWorker._SingleInstanceMeta__inst = None
+            try:
+                assert isinstance(MyWorker(helper.PATH, 'foobar'), StampedeStub)
+                assert isinstance(MyWorker(helper.PATH, 'foobar', None, False), StampedeStub)
+                assert MyWorker(helper.PATH, 'foobar', None, True).handoff is True
+                MyWorker._SingleInstanceMeta__inst = None
+                assert MyWorker(helper.PATH, 'foobar', handoff=True).handoff is True
+            finally:
+                MyWorker._SingleInstanceMeta__inst = None
+
+
 def test_double_instance():
     from stampede import StampedeWorker
     StampedeWorker._SingleInstanceMeta__inst = None